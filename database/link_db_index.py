@@ -0,0 +1,128 @@
+'''
+Compact read-only format for the link database, for lookups that start
+immediately. The file is memory mapped and a link is found with a binary search,
+so a lookup only reads the pages it needs instead of the whole database.
+
+File format (integers are unsigned 64 bit little endian):
+- "LINKIDX1" and the number of links n
+- n+1 offsets of the links in the key blob
+- n+1 offsets of the records in the record blob
+- key blob: the links (UTF-8), sorted by their bytes
+- record blob: the information object for each link as compact JSON (UTF-8),
+  in the same order as the links
+
+To create the file from a JSON database (compressed with xz if the name ends
+with .xz) or a SQLite database (see link_db_sqlite.py), run:
+
+python3 link_db_index.py <database file> <index file>
+
+The index file can then be given to read_link_db.py.
+'''
+
+from typing import Any, Dict, Iterator, Tuple, Union
+import json
+import mmap
+import struct
+import sys
+
+# Start of the file
+MAGIC = b'LINKIDX1'
+
+HEADER = struct.Struct('<8sQ')
+OFFSET = struct.Struct('<Q')
+
+def write(items: Iterator[Tuple[str,Dict[str,Any]]], file: str):
+    '''
+    Writes the index file for (link, information) pairs.
+    '''
+    entries = sorted((link.encode(),
+                      json.dumps(info,separators=(',',':')).encode())
+                     for link,info in items)
+    with open(file,'wb') as f:
+        f.write(HEADER.pack(MAGIC,len(entries)))
+        for blob in [0,1]: # key offsets, then record offsets
+            offset = 0
+            f.write(OFFSET.pack(offset))
+            for entry in entries:
+                offset += len(entry[blob])
+                f.write(OFFSET.pack(offset))
+        for blob in [0,1]:
+            for entry in entries:
+                f.write(entry[blob])
+
+class LinkIndex:
+    '''
+    A memory mapped index file. Supports len, "in" and get like the dictionary
+    of the JSON database.
+    '''
+
+    def __init__(self, file: str):
+        with open(file,'rb') as f:
+            self.data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        magic,self.count = HEADER.unpack_from(self.data,0)
+        if magic != MAGIC:
+            raise ValueError(f'not a link index file: {file}')
+        self.key_offsets = HEADER.size
+        self.record_offsets = self.key_offsets + OFFSET.size*(self.count+1)
+        self.keys = self.record_offsets + OFFSET.size*(self.count+1)
+        self.records = self.keys + self.offset(self.key_offsets,self.count)
+
+    def offset(self, table: int, i: int) -> int:
+        return OFFSET.unpack_from(self.data,table+OFFSET.size*i)[0]
+
+    def key(self, i: int) -> bytes:
+        return self.data[self.keys+self.offset(self.key_offsets,i):
+                         self.keys+self.offset(self.key_offsets,i+1)]
+
+    def record(self, i: int) -> bytes:
+        return self.data[self.records+self.offset(self.record_offsets,i):
+                         self.records+self.offset(self.record_offsets,i+1)]
+
+    def find(self, link: str) -> int:
+        ''' Position of the link, -1 if it is not in the index '''
+        key = link.encode()
+        lo,hi = 0,self.count
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self.key(mid) < key:
+                lo = mid+1
+            else:
+                hi = mid
+        return lo if lo < self.count and self.key(lo) == key else -1
+
+    def get(self, link: str) -> Union[Dict[str,Any],None]:
+        '''
+        Returns the information for a link, None if it is not in the index.
+        '''
+        i = self.find(link)
+        return json.loads(self.record(i)) if i >= 0 else None
+
+    def __contains__(self, link: str) -> bool:
+        return self.find(link) >= 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self):
+        self.data.close()
+
+def read_items(file: str) -> Iterator[Tuple[str,Dict[str,Any]]]:
+    '''
+    Reads (link, information) pairs from a JSON or SQLite database file.
+    '''
+    if file.endswith('.sqlite') or file.endswith('.db'):
+        import link_db_sqlite
+        conn = link_db_sqlite.connect_readonly(file)
+        for row in conn.execute('SELECT * FROM links'):
+            yield row[0], link_db_sqlite.row_info(conn,row)
+        conn.close()
+    else:
+        from make_link_db_v2 import read_db
+        yield from read_db(file).items()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.stderr.write('usage: link_db_index.py <database file> '
+                         '<index file>\n')
+        sys.exit(1)
+    write(read_items(sys.argv[1]),sys.argv[2])
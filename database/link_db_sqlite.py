@@ -0,0 +1,221 @@
+'''
+SQLite storage for the link database made by make_link_db_v2.py, as an
+alternative to the JSON file. A lookup only reads the rows it needs, so there is
+no need to load the whole database first.
+
+Tables:
+links: 1 row per link with a column for each attribute in OUTPUT_ATTR, and
+       "catbox" for the catbox file ID of the link (like "abc123" for
+       https://files.catbox.moe/abc123.webm, null for other sites). The list
+       attributes (JSON_ATTRS) are stored as JSON text, and any other value
+       that is not a string, number or null as a JSON blob.
+dates: (link, attr, date) for the attributes with a date, the "dates" property
+       of the JSON database.
+inputs: the input files applied to the database (file, size, mtime, sha1), see
+        the --update option of make_link_db_v2.py.
+
+The links table has indexes on link and catbox (used to look up catbox links,
+see read_link_db.py).
+
+Updating uses the same function (insert_info) as the JSON database: the links
+used by the new input files are loaded from the database when first needed
+(see SqliteLinks), updated in memory and written back.
+'''
+
+from typing import Any, Dict, Iterator, List, Pattern, Tuple, Union
+import json
+import os
+import pathlib
+import re
+import sqlite3
+
+from make_link_db_v2 import OUTPUT_ATTR
+
+# Attributes with a list value, stored as JSON text
+JSON_ATTRS : List[str] = ['altAnswers', 'animeTags', 'animeGenres']
+
+# Columns with an index (link is the primary key)
+INDEX_COLUMNS : List[str] = ['catbox']
+
+# Catbox link with the file ID
+CATBOX_LINK_RE : Pattern[str] = \
+    re.compile(r'https?://[\w.]*catbox\.(?:moe|video)/(\w+)\.\w+')
+
+def catbox_id(link: str) -> Union[str,None]:
+    '''
+    Returns the catbox file ID of a link (None if it is not a catbox link).
+    '''
+    match = CATBOX_LINK_RE.fullmatch(link)
+    return match.group(1) if match else None
+
+def connect(file: str) -> sqlite3.Connection:
+    '''
+    Opens the database file for writing, creating the tables if they do not
+    exist (see connect_readonly for lookups).
+    '''
+    conn = sqlite3.connect(file)
+    columns = ''.join(f', "{attr}"' for attr in OUTPUT_ATTR)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS links '
+                 f'(link TEXT PRIMARY KEY, catbox TEXT{columns})')
+    conn.execute('CREATE TABLE IF NOT EXISTS dates (link TEXT, attr TEXT, '
+                 'date TEXT, PRIMARY KEY (link, attr)) WITHOUT ROWID')
+    conn.execute('CREATE TABLE IF NOT EXISTS inputs '
+                 '(file TEXT, size INTEGER, mtime INTEGER, sha1 TEXT)')
+    for column in INDEX_COLUMNS:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "links_{column}" '
+                     f'ON links ("{column}")')
+    return conn
+
+def connect_readonly(file: str) -> sqlite3.Connection:
+    '''
+    Opens an existing database file for lookups. Nothing is created or written,
+    so a read-only file can be used and a wrong file name is an error instead
+    of a new empty database.
+    '''
+    if not os.path.isfile(file):
+        raise FileNotFoundError(f'database file not found: {file}')
+    return sqlite3.connect(pathlib.Path(file).resolve().as_uri()+'?mode=ro',
+                           uri=True)
+
+def encode(attr: str, value: Any) -> Any:
+    '''
+    Value for the column of an attribute. The list attributes are stored as
+    JSON text, other values that SQLite does not support (like bool or dict) as
+    JSON in a blob so that decode can tell them from strings.
+    '''
+    if attr in JSON_ATTRS:
+        return json.dumps(value)
+    if not (value is None or type(value) in [str,int,float]):
+        return json.dumps(value).encode()
+    return value
+
+def decode(attr: str, value: Any) -> Any:
+    ''' Inverse of encode '''
+    if type(value) == bytes or (attr in JSON_ATTRS and value is not None):
+        return json.loads(value)
+    return value
+
+def row_info(conn: sqlite3.Connection, row: Tuple) -> Dict[str,Any]:
+    '''
+    Creates the information object (like in the JSON database) for a row of
+    the links table (link, catbox, attributes...).
+    '''
+    info : Dict[str,Any] = {attr: decode(attr,value)
+                            for attr,value in zip(OUTPUT_ATTR,row[2:])}
+    info['dates'] = {attr: None for attr in OUTPUT_ATTR}
+    for attr,date in conn.execute('SELECT attr, date FROM dates '
+                                  'WHERE link = ?',(row[0],)):
+        info['dates'][attr] = date
+    return info
+
+def select(conn: sqlite3.Connection, column: str,
+           value: Any) -> Iterator[Tuple[str,Dict[str,Any]]]:
+    '''
+    Yields (link, information) for the links with the given value in a column
+    (link or one of INDEX_COLUMNS to use an index).
+    '''
+    cursor = conn.execute(f'SELECT * FROM links WHERE "{column}" = ?',(value,))
+    for row in cursor:
+        yield row[0], row_info(conn,row)
+
+def get(conn: sqlite3.Connection, link: str) -> Union[Dict[str,Any],None]:
+    '''
+    Returns the information for a link, None if it is not in the database.
+    '''
+    for _,info in select(conn,'link',link):
+        return info
+    return None
+
+# Maximum number of values in 1 query for get_many
+QUERY_SIZE = 500
+
+def get_many(conn: sqlite3.Connection,
+             links: List[str]) -> Dict[str,Dict[str,Any]]:
+    '''
+    Returns the information for the links that are in the database, with a few
+    queries for all of them instead of 1 query per link. Catbox links are found
+    with the catbox index, so the links tried for a catbox file ID (like .webm
+    and .mp3) need 1 lookup instead of 1 per link.
+    '''
+    wanted = set(links)
+    catbox = list({catbox_id(link) for link in wanted} - {None})
+    others = [link for link in wanted if catbox_id(link) is None]
+    result : Dict[str,Dict[str,Any]] = dict()
+    for column,values in [('catbox',catbox),('link',others)]:
+        for i in range(0,len(values),QUERY_SIZE):
+            chunk = values[i:i+QUERY_SIZE]
+            placeholders = ', '.join('?'*len(chunk))
+            for row in conn.execute(f'SELECT * FROM links WHERE "{column}" '
+                                    f'IN ({placeholders})',chunk):
+                if row[0] not in wanted:
+                    continue
+                info : Dict[str,Any] = {attr: decode(attr,value) for
+                                        attr,value in zip(OUTPUT_ATTR,row[2:])}
+                info['dates'] = {attr: None for attr in OUTPUT_ATTR}
+                result[row[0]] = info
+    found = list(result)
+    for i in range(0,len(found),QUERY_SIZE):
+        chunk = found[i:i+QUERY_SIZE]
+        placeholders = ', '.join('?'*len(chunk))
+        for link,attr,date in conn.execute(f'SELECT link, attr, date FROM '
+                                           f'dates WHERE link IN '
+                                           f'({placeholders})',chunk):
+            result[link]['dates'][attr] = date
+    return result
+
+def write(conn: sqlite3.Connection, db: Dict[str,Any]):
+    '''
+    Writes the links in db to the database, replacing their rows. Does not
+    commit.
+    '''
+    placeholders = ', '.join('?'*(len(OUTPUT_ATTR)+2))
+    conn.executemany(f'INSERT OR REPLACE INTO links VALUES ({placeholders})',
+        ((link,catbox_id(link))+tuple(encode(attr,info[attr])
+                                      for attr in OUTPUT_ATTR)
+         for link,info in db.items()))
+    conn.executemany('DELETE FROM dates WHERE link = ?',
+                     ((link,) for link in db))
+    conn.executemany('INSERT INTO dates VALUES (?, ?, ?)',
+        ((link,attr,date) for link,info in db.items()
+         for attr,date in info['dates'].items() if date is not None))
+
+class SqliteLinks(dict):
+    '''
+    Dictionary of link to information (like the JSON database) for updating a
+    database file. A link that is not in the dictionary is loaded from the
+    database when checked with "in", so insert_info sees the data in the
+    database while only the links it uses are held in memory. Call save to
+    write the changes (not committed).
+    '''
+
+    def __init__(self, conn: sqlite3.Connection):
+        super().__init__()
+        self.conn = conn
+
+    def __contains__(self, link: object) -> bool:
+        if dict.__contains__(self,link):
+            return True
+        info = get(self.conn,link) if type(link) == str else None
+        if info is None:
+            return False
+        self[link] = info
+        return True
+
+    def save(self):
+        write(self.conn,self)
+
+def applied_inputs(conn: sqlite3.Connection) -> List[Dict[str,Any]]:
+    '''
+    Returns the input files applied to the database (like db_file.inputs.json
+    for the JSON database).
+    '''
+    return [{'file':file,'size':size,'mtime':mtime,'sha1':sha1}
+            for file,size,mtime,sha1 in
+            conn.execute('SELECT file, size, mtime, sha1 FROM inputs')]
+
+def add_inputs(conn: sqlite3.Connection, inputs: List[Dict[str,Any]]):
+    '''
+    Records input files as applied to the database. Does not commit.
+    '''
+    conn.executemany('INSERT INTO inputs VALUES (?, ?, ?, ?)',
+        ((i['file'],i['size'],i['mtime'],i['sha1']) for i in inputs))
@@ -44,16 +44,50 @@ python3 make_link_db_v2.py [files and directories ...] > output_file
 All directories will be processed recursively and data will be collected from
 every input file found.
 
-Currently, adding to an existing database file is not supported. The script only
-needs to run once to create the database and it is not prohibitively expensive
-for realistic amounts of data currently.
+To add to an existing database file instead, use the --update option:
 
-TODO support adding to an existing database file
+python3 make_link_db_v2.py --update=db_file [files and directories ...]
+
+The database is loaded from db_file (compressed with xz if the name ends with
+.xz), only the input files that were not applied to it before are processed, and
+the result is written back to db_file. The applied input files are listed in
+db_file.inputs.json (path, size, mtime and SHA-1 of each), so a file is skipped
+when it has the same contents and the same date in its name as one already
+applied, even if it was moved or renamed (a copy with a different date is
+applied, since the date of its data comes from the name). If db_file does not
+exist, it is created. The same rule for the dates is used, so the result is the
+same as rebuilding the database with the new files given after the old ones.
+Applying a file again does not change the database, so an update interrupted
+before the inputs list is written is safe to run again.
+
+To write a SQLite database instead of JSON, use the --sqlite option:
+
+python3 make_link_db_v2.py --sqlite=db_file [files and directories ...]
+
+This works like --update (the file is created or only new input files are
+added), with the database in the format described in link_db_sqlite.py. Lookups
+in it use indexes and do not need to load the whole database, see
+read_link_db.py.
+
+The input files can be parsed in parallel with the --workers option:
+
+python3 make_link_db_v2.py --workers=N [files and directories ...] > output_file
+
+N worker processes (or the number of CPUs if N is 0) each parse input files
+into a separate partial database, and these are merged in the order of the
+input files using the same rule for the dates. The result is the same as
+processing the files 1 at a time. This can be combined with --update and
+--sqlite.
 '''
 
 from itertools import chain
-from typing import Any, Dict, Iterator, List, Pattern, Union
+from typing import Any, Dict, Iterator, List, Pattern, Tuple, Union
+import concurrent.futures
+import contextlib
+import hashlib
+import io
 import json
+import lzma
 import os
 import re
 import sys
@@ -174,6 +208,54 @@ Expand library URLs are contained in the "examples" attribute, which maps a
 resolution or "mp3" to the url.
 '''
 
+def new_info() -> Dict[str,Any]:
+    '''
+    Returns the information object for a link with default null values.
+    '''
+    info : Dict[str,Any] = dict()
+    for attr_ in OUTPUT_ATTR:
+        info[attr_] = None
+    info['dates'] = dict()
+    for attr_ in OUTPUT_ATTR: # null date for each attribute
+        info['dates'][attr_] = None
+    return info
+
+def update_info(info: Dict[str,Any], attr: str, value: Any,
+                date: Union[str,None]):
+    '''
+    Sets an attribute of an information object. If the data already exists, it
+    is replaced only if a later date is provided (or any date if no date is
+    associated with the existing data).
+    '''
+    old_date = info['dates'][attr]
+    if old_date is None: # for comparing dates as str
+        old_date = ''
+    if info[attr] is None or \
+        (date is not None and date > old_date):
+        info[attr] = value
+        info['dates'][attr] = date
+
+class PartialDB(dict):
+    '''
+    Database for 1 input file, made by a worker process when building in
+    parallel (see add_files). Records which attributes were inserted for each
+    link, so attributes that were not inserted are not merged, and whether the
+    data is simple enough to merge as is (see merge_partial).
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.touched : Dict[str,set] = dict() # link -> inserted attributes
+        self.dates : set = set() # dates of the inserted data
+        self.null_values = False # any null value inserted
+
+    def record(self, links: List[str], attr: str, value: Any,
+               date: Union[str,None]):
+        for link in links:
+            self.touched.setdefault(link,set()).add(attr)
+        self.dates.add(date)
+        self.null_values = self.null_values or value is None
+
 def insert_info(db: Dict[str,dict], links: List[str],
                 attr: str, value: Any, date: Union[str,None]):
     '''
@@ -189,20 +271,11 @@ def insert_info(db: Dict[str,dict], links: List[str],
         sys.stderr.write(f'    links = {links}\n')
     for link in links: # ensure default null values are in the database
         if link not in db:
-            db[link] = dict()
-            for attr_ in OUTPUT_ATTR:
-                db[link][attr_] = None
-            db[link]['dates'] = dict()
-            for attr_ in OUTPUT_ATTR: # null date for each attribute
-                db[link]['dates'][attr_] = None
+            db[link] = new_info()
+    if isinstance(db,PartialDB):
+        db.record(links,attr,value,date)
     for link in links:
-        old_date = db[link]['dates'][attr]
-        if old_date is None: # for comparing dates as str
-            old_date = ''
-        if db[link][attr] is None or \
-            (date is not None and date > old_date):
-            db[link][attr] = value
-            db[link]['dates'][attr] = date
+        update_info(db[link],attr,value,date)
 
 def add_approvals(db: Dict[str,dict], data: dict):
     '''
@@ -347,6 +420,24 @@ def add_exp_lib(db: Dict[str,dict], data: List[Any], date: Union[str,None]):
 # Set to False for debugging so the script fails completely on error
 HANDLE_EXCEPTIONS = True
 
+def file_date(file: str, warn: bool = False) -> Union[str,None]:
+    '''
+    Returns the date (YYYY-MM-DD) found in the file path with DATE_FORMATS, or
+    None if there is no date in range. Dates out of range are reported if warn
+    is True.
+    '''
+    for fmt in DATE_FORMATS:
+        match = fmt.search(file)
+        if not match:
+            continue
+        date = '-'.join(match.groups())
+        if not check_date(date):
+            if warn:
+                sys.stderr.write(f'    Date {date} out of range, not using\n')
+            continue
+        return date
+    return None
+
 def add_from_file(db: Dict[str,Any], file: str):
     sys.stderr.write(f'Processing file: {file}\n')
 
@@ -369,17 +460,7 @@ def add_from_file(db: Dict[str,Any], file: str):
         return
 
     # Extract date from filename
-    date : Union[str,None] = None
-    for fmt in DATE_FORMATS:
-        match = fmt.search(file)
-        if not match:
-            continue
-        date_ = '-'.join(match.groups())
-        if not check_date(date_):
-            sys.stderr.write(f'    Date {date_} out of range, not using\n')
-            continue
-        date = date_
-        break
+    date = file_date(file,True)
 
     # No date
     if date is None:
@@ -414,23 +495,195 @@ def add_from_file(db: Dict[str,Any], file: str):
             else:
                 raise e
 
-if __name__ == '__main__':
+def parse_file(file: str) -> Tuple[Union[PartialDB,None],str]:
+    '''
+    Creates the partial database for 1 input file (run in a worker process).
+    Returns the partial database (None if it cannot be merged exactly, see
+    merge_partial) and the messages written to STDERR while processing it.
+    '''
+    partial = PartialDB()
+    messages = io.StringIO()
+    with contextlib.redirect_stderr(messages):
+        add_from_file(partial,file)
+    if len(partial.dates) > 1 and partial.null_values:
+        return None,messages.getvalue()
+    return partial,messages.getvalue()
+
+def merge_partial(db: Dict[str,Any], partial: PartialDB):
+    '''
+    Adds the data from the partial database of 1 input file to the database.
+    The result is the same as with add_from_file for the file: the links are
+    added in the same order, and inserting the final value of each attribute
+    in the file gives the same result as inserting the values 1 at a time if
+    all the data in the file has the same date (like song lists and expand
+    library dumps) or no null values (like approvals dumps).
+    '''
+    for link,info in partial.items():
+        if link not in db:
+            db[link] = new_info()
+        for attr in partial.touched[link]:
+            update_info(db[link],attr,info[attr],info['dates'][attr])
 
+def add_files(db: Dict[str,Any], files: Iterator[str], workers: int = 1):
+    '''
+    Adds the input files to the database in order (see add_from_file). With
+    more than 1 worker, the files are parsed in parallel by worker processes
+    and the results are merged in order, giving the same database as
+    processing them 1 at a time. Files that cannot be merged exactly are
+    processed again by add_from_file.
+    '''
+    if workers == 1:
+        for file in files:
+            add_from_file(db,file)
+        return
+    files = list(files)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for file,(partial,messages) in zip(files,
+                                           executor.map(parse_file,files)):
+            if partial is None:
+                add_from_file(db,file)
+                continue
+            sys.stderr.write(messages)
+            merge_partial(db,partial)
+
+def input_files(args: List[str]) -> Iterator[str]:
+    '''
+    Returns the files given in args followed by all files in the given
+    directories, with normed paths.
+    '''
     # Get files and dirs with normed paths
-    arg_norm  : List[str] = list(map(os.path.normpath, sys.argv[1:]))
+    arg_norm  : List[str] = list(map(os.path.normpath, args))
     arg_files : Iterator[str] = filter(os.path.isfile, arg_norm)
     arg_dirs  : Iterator[str] = filter(os.path.isdir , arg_norm)
 
     # Chain given files with all files in each given directory
-    inputs : Iterator[str] = chain(arg_files,
+    return chain(arg_files,
         chain.from_iterable(walk_files(dir) for dir in arg_dirs))
 
+def read_db(file: str) -> Dict[str,Any]:
+    '''
+    Reads a database file (compressed with xz if the name ends with .xz).
+    '''
+    opener = lzma.open if file.endswith('.xz') else open
+    with opener(file,'rt') as f:
+        return json.loads(f.read())
+
+def write_db(db: Dict[str,Any], file: str):
+    '''
+    Writes a database file (compressed with xz if the name ends with .xz). The
+    file is replaced only after it is written completely.
+    '''
+    opener = lzma.open if file.endswith('.xz') else open
+    with opener(file+'.tmp','wt') as f:
+        f.write(json.dumps(db,separators=(',',':')))
+    os.replace(file+'.tmp',file)
+
+def file_hash(file: str) -> str:
+    '''
+    SHA-1 of the file contents (hex).
+    '''
+    sha1 = hashlib.sha1()
+    with open(file,'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def apply_new_inputs(db: Dict[str,Any], inputs: Iterator[str],
+                     applied: List[Dict[str,Any]], workers: int = 1) \
+        -> Tuple[List[Dict[str,Any]],bool]:
+    '''
+    Adds the input files that are not in the applied list to the database
+    (with workers processes, see add_files). A file is already applied if it
+    has the same contents and the same date in its name as an applied file,
+    since the date used for its data comes from the name. Returns the list of
+    new input files (file, size, mtime, sha1) to record as applied and whether
+    the database changed.
+    '''
+    applied_stats = {(a['file'],a['size'],a['mtime']) for a in applied}
+    applied_keys = {(a['sha1'],file_date(a['file'])) for a in applied}
+
+    new : List[Dict[str,Any]] = []
+    to_add : List[str] = []
+    for file in inputs:
+        stat = os.stat(file)
+        if (file,stat.st_size,stat.st_mtime_ns) in applied_stats:
+            continue # same file as before, no need to hash it
+        sha1 = file_hash(file)
+        if (sha1,file_date(file)) not in applied_keys:
+            to_add.append(file)
+            applied_keys.add((sha1,file_date(file)))
+        else:
+            sys.stderr.write(f'Already applied: {file}\n')
+        new.append({'file':file,'size':stat.st_size,'mtime':stat.st_mtime_ns,
+                    'sha1':sha1})
+
+    add_files(db,to_add,workers)
+    sys.stderr.write(f'{len(new)} new input files\n')
+    return new,len(to_add) > 0
+
+def update_db(db_file: str, inputs: Iterator[str], workers: int = 1):
+    '''
+    Adds the input files that were not applied before to the database in
+    db_file (see the module documentation for --update).
+    '''
+    inputs_file = db_file+'.inputs.json'
+    db : Dict[str,Any] = read_db(db_file) if os.path.exists(db_file) else dict()
+    applied : List[Dict[str,Any]] = \
+        json.loads(open(inputs_file,'r').read()) \
+        if os.path.exists(inputs_file) else []
+    new,changed = apply_new_inputs(db,inputs,applied,workers)
+    if changed:
+        write_db(db,db_file)
+    if len(new) == 0:
+        return
+    with open(inputs_file+'.tmp','w') as f:
+        f.write(json.dumps(applied+new,indent=4))
+    os.replace(inputs_file+'.tmp',inputs_file)
+
+def update_sqlite(db_file: str, inputs: Iterator[str], workers: int = 1):
+    '''
+    Adds the input files that were not applied before to the SQLite database in
+    db_file (see the module documentation for --sqlite).
+    '''
+    import link_db_sqlite
+    conn = link_db_sqlite.connect(db_file)
+    db = link_db_sqlite.SqliteLinks(conn)
+    new,_ = apply_new_inputs(db,inputs,link_db_sqlite.applied_inputs(conn),
+                             workers)
+    db.save()
+    link_db_sqlite.add_inputs(conn,new)
+    conn.commit() # links and inputs together
+    conn.close()
+
+if __name__ == '__main__':
+
+    args      : List[str] = [arg for arg in sys.argv[1:]
+                             if not arg.startswith('--')]
+    db_file   : Union[str,None] = None
+    sqlite_db : Union[str,None] = None
+    workers   : int = 1
+    for arg in sys.argv[1:]:
+        if arg.startswith('--update='):
+            db_file = arg[len('--update='):]
+        elif arg.startswith('--sqlite='):
+            sqlite_db = arg[len('--sqlite='):]
+        elif arg.startswith('--workers='):
+            workers = int(arg[len('--workers='):] or 0) or os.cpu_count() or 1
+
+    inputs : Iterator[str] = input_files(args)
+
+    if db_file is not None: # add to an existing database file
+        update_db(db_file,inputs,workers)
+        sys.exit()
+
+    if sqlite_db is not None: # create or add to a SQLite database
+        update_sqlite(sqlite_db,inputs,workers)
+        sys.exit()
+
     database : Dict[str,Any] = dict()
 
     # Collect data from each file
-    for file in inputs:
-        add_from_file(database,file)
-        
+    add_files(database,inputs,workers)
+
     # Write output
     sys.stdout.write(json.dumps(database,separators=(',',':')))
-
@@ -1,29 +1,122 @@
+'''
+Reads links (or catbox file IDs) from STDIN and prints the information from the
+link database for each.
+
+Usage: read_link_db.py [database file] [--batch[=links file]]
+
+The database file is db.json.xz by default (a JSON database is read with xz
+decompression only if the name ends with .xz). A SQLite database (made with the
+--sqlite option of make_link_db_v2.py, file name ending with .sqlite or .db) or
+an index file (made with link_db_index.py, file name ending with .idx) is used
+without loading it into memory, so lookups can start immediately.
+
+With --batch, all the links are read first (from the links file or STDIN, 1 per
+line) and looked up together, then 1 line of JSON is written for each:
+{"query": str, "status": "hit" or "miss", "link": str, "info": object}
+with link and info null for a miss. The same lookup is available to other
+scripts as lookup_many.
+'''
+
+from typing import Any, Dict, Iterable, List, Tuple, Union
 import json
-import lzma
 import sys
-sys.stderr.write('reading database...\n')
-db = json.loads(lzma.open('db.json.xz','rt').read())
-sys.stderr.write(f'done reading ({len(db)} links)\n')
+
 link_readers = [
     lambda x : x,
     lambda x : f'https://files.catbox.moe/{x}.webm',
     lambda x : f'https://files.catbox.moe/{x}.mp3'
 ]
-while True:
-    try:
-        link = input()
-    except:
-        break
-    any_worked = False
-    for lr in link_readers:
-        link2 = lr(link)
+
+class LinkDB:
+    '''
+    A link database file opened for lookups (see the module documentation for
+    the supported formats).
+    '''
+
+    def __init__(self, db_file: str = 'db.json.xz'):
+        self.conn = None
+        self.index = None
+        self.db : Union[Dict[str,Any],None] = None
+        if db_file.endswith('.sqlite') or db_file.endswith('.db'):
+            import link_db_sqlite
+            self.conn = link_db_sqlite.connect_readonly(db_file)
+        elif db_file.endswith('.idx'):
+            import link_db_index
+            self.index = link_db_index.LinkIndex(db_file)
+        else:
+            from make_link_db_v2 import read_db
+            sys.stderr.write('reading database...\n')
+            self.db = read_db(db_file)
+            sys.stderr.write(f'done reading ({len(self.db)} links)\n')
+
+    def get_many(self, links: List[str]) -> Dict[str,Dict[str,Any]]:
+        '''
+        Returns the information for the links that are in the database.
+        '''
+        if self.conn is not None:
+            import link_db_sqlite
+            return link_db_sqlite.get_many(self.conn,links)
+        source = self.index if self.index is not None else self.db
+        result : Dict[str,Dict[str,Any]] = dict()
+        for link in sorted(set(links)): # sorted for locality in the index
+            info = source.get(link)
+            if info is not None:
+                result[link] = info
+        return result
+
+def candidates(query: str) -> List[str]:
+    '''
+    Links to try for a query, in order: the query itself (full URL), then as a
+    catbox file ID with .webm and .mp3.
+    '''
+    query = query.strip()
+    if query.startswith('http'):
+        return [query]
+    return [lr(query) for lr in link_readers]
+
+def lookup_many(db: LinkDB, queries: Iterable[str]) \
+        -> List[Tuple[str,Union[str,None],Union[Dict[str,Any],None]]]:
+    '''
+    Looks up all the queries (links or catbox file IDs) in 1 pass. Returns
+    (query, link, information) for each query in order, with link and
+    information None if it is not found.
+    '''
+    queries = list(queries)
+    tried = [candidates(query) for query in queries]
+    found = db.get_many([link for links in tried for link in links])
+    result = []
+    for query,links in zip(queries,tried):
+        link = next((link for link in links if link in found),None)
+        result.append((query,link,found[link] if link is not None else None))
+    return result
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    batch : Union[str,None] = None
+    for arg in sys.argv[1:]:
+        if arg == '--batch':
+            batch = '-'
+        elif arg.startswith('--batch='):
+            batch = arg[len('--batch='):]
+    db = LinkDB(args[0] if len(args) > 0 else 'db.json.xz')
+
+    if batch is not None: # look up all links, write JSON lines
+        source = sys.stdin if batch == '-' else open(batch,'r')
+        queries = [line.strip() for line in source if line.strip() != '']
+        for query,link,info in lookup_many(db,queries):
+            sys.stdout.write(json.dumps({'query':query,
+                'status':'miss' if link is None else 'hit',
+                'link':link,'info':info})+'\n')
+        sys.exit()
+
+    while True:
         try:
-            data = db[link2]
+            link = input()
+        except:
+            break
+        [(_,link2,data)] = lookup_many(db,[link])
+        if data is not None:
             print(f'LINK = {repr(link2)}')
             print(json.dumps(data,indent=4))
-            any_worked = True
-            break
-        except:
-            pass
-    if not any_worked:
-        sys.stderr.write(f'could not understand link: {link}\n')
+        else:
+            sys.stderr.write(f'could not understand link: {link}\n')
@@ -2,17 +2,21 @@
 Reads all the files from:
 <dir>/amq_<year>s<season>_<day>_<date>_<region>_.json
 
-Specify <dir> as single command line argument.
+Specify <dir> as the first command line argument. An optional second argument
+gives the number of worker processes to load with. Zip archives (such as the ones
+in ranked_data_zip) found in <dir> are read in place without extracting them,
+and <dir> may also be a single zip archive.
 
 Produces an object containing all the ranked AMQ data stored.
 '''
 
-import bz2 # significantly better than gzip but not very slow
+import concurrent.futures
+import hashlib
 import json
 import os
-import pickle
 import re
 import sys
+import zipfile
 
 re_fname = re.compile(r'amq_(\d{4})s(\d\d)_(ch|\d\d)_(\d{4})-(\d\d)-(\d\d)_'
                        '(east|central|west)\.json')
@@ -27,6 +31,33 @@ def all_files(file):
         return sum(filelists,[])
     else: return []
 
+# yields (file name, file contents) for every ranked file in the input
+# zip archives are streamed member by member instead of being extracted
+def ranked_files(file):
+    for path in all_files(file):
+        if path.endswith('.zip'):
+            with zipfile.ZipFile(path,'r') as archive:
+                # sort members to get the same order as an extracted directory
+                for info in sorted(archive.infolist(),key=lambda i:i.filename):
+                    if info.is_dir(): continue
+                    yield info.filename, archive.read(info)
+        else:
+            with open(path,'rb') as f:
+                yield path, f.read()
+
+# creates the ranked object for a file, using the file name for metadata
+def parse_ranked_file(file,contents):
+    year,season,num,y,m,d,region = \
+        re_fname.fullmatch(os.path.basename(file)).groups()
+    obj = dict()
+    obj['region'] = region
+    obj['year'] = int(year)
+    obj['season'] = int(season)
+    obj['number'] = -1 if num == 'ch' else int(num)
+    obj['date'] = '%s-%s-%s'%(y,m,d)
+    obj['data'] = json.loads(contents)
+    return obj
+
 # map attributes in reformatted to those in original data
 # different scrypt versions may name them differently
 attr_mapping = \
@@ -87,7 +118,150 @@ def clean_ranked_data(data):
             else:
                 match['data'][i] = cleaned
 
-def read_ranked_data(dir,use_cached_obj=False,store_cached_obj=True):
+# parses and cleans all ranked files in a path (file, zip archive or directory)
+# this is the unit of work given to each worker process by load_ranked_parts
+def load_ranked_path(path):
+    data = [parse_ranked_file(file,contents)
+            for file,contents in ranked_files(path)]
+    clean_ranked_data(data)
+    return data
+
+# directory with the cached columnar data (see ranked_columns.py)
+CACHE_DIR = 'ranked_data.cache'
+
+# returns [file,size,mtime] for each input file so changes can be detected
+def source_manifest(dir):
+    files = []
+    for path in all_files(dir):
+        stat = os.stat(path)
+        files.append([path,stat.st_size,stat.st_mtime_ns])
+    return files
+
+# sha1 of a file, to check if a file with a new mtime actually changed
+def file_hash(path):
+    with open(path,'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# parses and cleans the given paths, with a process pool if workers != 1
+# returns a list with the ranked objects from each path
+def load_ranked_parts(paths,workers=1):
+    if workers == 1:
+        return [load_ranked_path(path) for path in paths]
+    if workers is None:
+        workers = os.cpu_count()
+    # loose files are sent in chunks to limit the overhead per task
+    chunksize = max(1,len(paths)//(4*workers))
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        # map returns results in input order regardless of finishing order
+        return list(executor.map(load_ranked_path,paths,chunksize=chunksize))
+
+# same as load_ranked_parts but returns all ranked objects in 1 list
+def load_ranked_paths(paths,workers=1):
+    return sum(load_ranked_parts(paths,workers),[])
+
+# builds the columnar data from scratch
+# returns the columns and the manifest entries [file,size,mtime,sha1,matches]
+def build_ranked_columns(sources,workers):
+    import ranked_columns
+    parts = load_ranked_parts([file for file,_,_ in sources],workers)
+    files = [source+[file_hash(source[0]),len(part)]
+             for source,part in zip(sources,parts)]
+    return ranked_columns.from_ranked_data(sum(parts,[])),files
+
+# updates the cached columnar data, only loading new or changed input files
+# returns the columns and the manifest entries like build_ranked_columns
+# the columns are None if the cached data is still correct
+def update_ranked_columns(cache,manifest,sources,workers):
+    import ranked_columns
+    cached = {entry[0]: entry for entry in manifest['files']}
+    start = 0 # match index where each cached file starts
+    starts = dict()
+    for entry in manifest['files']:
+        starts[entry[0]] = start
+        start += entry[4]
+    
+    # find which files need to be loaded, a different mtime with the same size
+    # and hash is not considered a change
+    files = []
+    changed = []
+    for source in sources:
+        entry = cached.get(source[0])
+        if entry is not None and entry[1:3] == source[1:3]:
+            files.append(entry)
+            continue
+        sha1 = file_hash(source[0])
+        if entry is not None and entry[1] == source[1] and entry[3] == sha1:
+            files.append(source+entry[3:])
+        else:
+            files.append(source+[sha1,None])
+            changed.append(source[0])
+    
+    if not changed and [entry[0] for entry in files] == list(cached):
+        return None,files
+    
+    old_cols = ranked_columns.load(cache)
+    parts = load_ranked_parts(changed,workers)
+    new_data = sum(parts,[])
+    new_cols = ranked_columns.from_ranked_data(new_data,old_cols.strings)
+    
+    # concatenate unchanged matches from the cache with the new ones in order
+    pieces = []
+    new_start = 0
+    parts = iter(parts)
+    for entry in files:
+        if entry[4] is None:
+            entry[4] = len(next(parts))
+            pieces.append((new_cols,new_start,new_start+entry[4]))
+            new_start += entry[4]
+        else:
+            start = starts[entry[0]]
+            pieces.append((old_cols,start,start+entry[4]))
+    return ranked_columns.combine(pieces,new_cols.strings),files
+
+def read_ranked_columns(dir=None,use_cached_obj=True,store_cached_obj=True,
+                        workers=1,cache=CACHE_DIR,incremental=True):
+    '''
+    Returns the ranked data as a columnar dataset (see ranked_columns.py, this
+    requires numpy). The cache directory stores the columns as arrays that are
+    memory mapped when loading, so nothing is decoded until it is used.
+    The cache records the name, size, modification time and hash of every input
+    file and is updated automatically if any of them changed. If dir is None,
+    the input directory recorded in the cache is used.
+    With incremental=True, only the new or changed input files (zip archives or
+    ranked JSON files) are loaded and the rest of the data is taken from the
+    cache, so adding a day or season does not reload all the past seasons.
+    Otherwise everything is loaded again when any input changes.
+    '''
+    import ranked_columns # requires numpy so it is only imported when needed
+    manifest = ranked_columns.read_manifest(cache)
+    if dir is None:
+        if manifest is None:
+            raise ValueError('no input given and no cache found in "%s"'%cache)
+        dir = manifest['input']
+    dir = os.path.abspath(dir)
+    sources = source_manifest(dir)
+    
+    if not use_cached_obj or manifest is None or manifest['input'] != dir:
+        cols,files = build_ranked_columns(sources,workers)
+    elif [entry[:3] for entry in manifest['files']] == sources:
+        return ranked_columns.load(cache)
+    elif incremental:
+        cols,files = update_ranked_columns(cache,manifest,sources,workers)
+        if cols is None: # only modification times changed
+            cols = ranked_columns.load(cache)
+            if store_cached_obj:
+                ranked_columns.write_manifest(cols,cache,
+                    {'input':dir,'files':files})
+            return cols
+    else:
+        cols,files = build_ranked_columns(sources,workers)
+    
+    if store_cached_obj:
+        ranked_columns.save(cols,cache,{'input':dir,'files':files})
+    
+    return cols
+
+def read_ranked_data(dir,use_cached_obj=False,store_cached_obj=True,workers=1):
     '''
     Returns a list containing ranked objects (type dict) that look like:
     {
@@ -98,41 +272,32 @@ def read_ranked_data(dir,use_cached_obj=False,store_cached_obj=True):
         "date": "2020-11-21"
         "data": [object read from the JSON file on disk]
     }
-    May store/read the data from "ranked_data.pickle" to speed things up
-    depending on the options provided
+    The dir argument may be a directory (searched recursively), a single ranked
+    JSON file, or a zip archive of ranked JSON files. Zip archives found while
+    searching a directory are read directly.
+    With workers > 1 (or None to use every CPU), the files or season zip
+    archives are parsed and cleaned by a pool of worker processes. Results are
+    merged in the same order as the serial loader so the output is identical.
+    May store/read the data from the cache in "ranked_data.cache" to speed
+    things up depending on the options provided (see read_ranked_columns). The
+    cache is skipped if numpy is not available.
     '''
-    if use_cached_obj and os.path.isfile('ranked_data.pickle.bz2'):
-        data = pickle.load(bz2.BZ2File('ranked_data.pickle.bz2','rb'))
-        return data
+    if use_cached_obj or store_cached_obj:
+        try:
+            cols = read_ranked_columns(dir,use_cached_obj,store_cached_obj,
+                                       workers)
+            return cols.to_ranked_data()
+        except ImportError:
+            sys.stderr.write('numpy not available, not using the cache\n')
     
-    filelist = all_files(dir)
-    data = []
-    
-    # process files in the directory
-    for file in filelist:
-        i = len(file)-1
-        while i >= 0 and file[i] != '/': i -= 1 # find last /
-        year,season,num,y,m,d,region = re_fname.fullmatch(file[i+1:]).groups()
-        obj = dict()
-        obj['region'] = region
-        obj['year'] = int(year)
-        obj['season'] = int(season)
-        obj['number'] = -1 if num == 'ch' else int(num)
-        obj['date'] = '%s-%s-%s'%(y,m,d)
-        obj['data'] = json.loads(open(file,'r').read())
-        data.append(obj)
-    
-    # clean data as well to finish processing
-    clean_ranked_data(data)
-
-    if store_cached_obj:
-        pickle.dump(data,bz2.BZ2File('ranked_data.pickle.bz2','wb'))
-    
-    return data
+    # process files in the directory (and any zip archives in it)
+    # data is cleaned as well to finish processing
+    return load_ranked_paths(all_files(dir),workers)
 
 if __name__ == '__main__':
     print('reading ranked data')
-    data = read_ranked_data(sys.argv[1])
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    data = read_ranked_data(sys.argv[1],workers=workers)
     print('done reading')
     print(len(data),'ranked files loaded')
     print(sum(len(match['data']) for match in data),'songs loaded')
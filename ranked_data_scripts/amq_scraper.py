@@ -12,33 +12,99 @@ all possible issues that may show up.
 
 Structure/format of the resulting output:
 <output dir>/amq_<year>s<season>_<day>_<date>_<region>_.json
+or with --archive, 1 zip file per season like in ranked_data_zip:
+<output dir>/amq_<year>s<season>.zip
+containing amq_<year>s<season>/amq_<year>s<season>_<day>_<date>_<region>_.json
+
+Usage: amq_scraper.py <sheet csv or dir>... <output dir> [options]
+
+Any number of sheets can be given, a directory means all the sheets in it (with
+the file name format from google sheets, like the ranked_sheets directory).
+
+Options:
+--workers=<n>   number of download threads for each site (default 8)
+--interval=<s>  minimum seconds between requests to the same host (default 0.5)
+--host-connections=<n>
+                maximum downloads from the same host at the same time
+                (default 4)
+(sites can set their own interval and connections, see SITE_HANDLERS)
+--cache=<dir>   directory for the http response cache (default
+                amq_scraper.cache), none to disable it
+--dead-ttl=<h>  hours to skip a url after it failed (default 24)
+--retries=<n>   times to retry a request after a transient error (default 4)
+--journal=<file>
+                file for the job journal (default amq_scraper.journal), none
+                to disable it
+--validated=<file>
+                file listing the validated files (default
+                amq_scraper.validated.json), none to disable it
+--check-workers=<n>
+                processes checking existing files (default cpu count)
+--archive[=<compression>]
+                write into per season zip archives, compression is deflate
+                (default), lzma or bzip2
+--compact       write json without whitespace instead of with indent=4
+
+The links from all the sheets are collected first, then downloaded
+concurrently sharing 1 HTTP session (so connections are reused). Each site
+(pastebin, gist, see SITE_HANDLERS) has its own threads and limits, so a slow
+site does not hold up the downloads from the others. A url that appears more
+than once is downloaded once. The checks of existing files and the writing of
+the downloaded files are the same as when downloading 1 at a time. A summary
+of the number of files with each status (success, failed download, json error,
+...) is printed at the end.
+
+Responses are saved in a cache directory with their ETag/Last-Modified headers,
+so when a file has to be downloaded again the request is conditional and an
+unchanged file is not transferred again. The raw links found on gist pages are
+saved too, so the pages are not fetched again. Urls that failed (4xx responses)
+are not requested again until the dead TTL passes.
+
+Connection errors, timeouts, 429 and 5xx responses are retried with
+exponential backoff and random jitter. Downloaded files are written
+atomically, so an interrupted or partly failed run can simply be run again: the
+files that exist are kept and the missing ones are downloaded. The status of
+each file (keyed by year, season, day and region) is appended to a journal file
+when it changes. The journal is a record of what each run did, for checking
+which files failed and why; it does not decide which files are downloaded. A
+sheet row that cannot be parsed is reported without stopping the rest of the
+sheet.
+
+Existing files are checked to be valid json and rewritten in the normalized
+format (indent=4) if needed. The files that passed are listed with their size,
+mtime and hash in a validated files list, so on later runs the unchanged ones
+are skipped without reading them. The files that need checking are checked in
+parallel in several processes.
+
+With --archive, the files go directly into the season zip archives, which the
+loader reads without extracting them. Downloaded files are added in batches and
+each update writes a new archive that replaces the old one, so an archive is
+never left partially written. With --compact, the json is written without
+whitespace (existing files in the other format are rewritten).
 
 Spreadsheet link:
 https://docs.google.com/spreadsheets/d/1g0jW7k-GJiHueQ0ZVYe4WilupnUkBYLVlbB9GEdqQ98/
 '''
 
-if __name__ != '__main__': quit() # only run scraper as main
-
 import bs4
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import hashlib
 import json
 import os
+import random
 import re
 import requests
+import requests.adapters
+import shutil
 import sys
-
-if len(sys.argv) != 3:
-    print('usage: amq_scraper.py <sheet csv> <output dir>')
-    quit()
-
-# sheet data to process
-sheet = sys.argv[1]
-
-# dir to store output in
-outdir = os.path.normpath(sys.argv[2])
-
-if not os.path.isdir(outdir):
-    os.mkdir(outdir)
+import threading
+import time
+import urllib.parse
+import zipfile
+import zlib
 
 # \d{4} is 4 digit year, \d\d? is 1 or 2 digit season number
 re_sheet_name = re.compile(r'Ranked AMQ Data Links - (\d{4}) S(\d\d?).csv')
@@ -58,53 +124,373 @@ def get_year_and_season(sheet):
     ''' returns tuple of 2 integers '''
     return (int(sheet[24:28]),int(sheet[30:sheet.find('.')]))
 
-# if more sites are needed in the future, might be good to design this to try
-# several scrapers, each with a url regex and a scraper function
-def download_url(link):
-    ''' returns (success_bool, result_str)
-    if successful, result_str is json data, otherwise it is error message '''
-    link = link.strip()
+# default number of downloads running at the same time
+DOWNLOAD_WORKERS = 8
+
+# default minimum seconds between starting requests to the same host
+HOST_INTERVAL = 0.5
+
+# default maximum number of requests to the same host at the same time
+HOST_CONNECTIONS = 4
+
+# seconds to wait for a server before giving up on a request
+REQUEST_TIMEOUT = 60
+
+class HostLimiter:
+    ''' limits the requests to each host (shared by all download threads)
+    at most max_connections requests to a host run at the same time and the
+    starts of requests to a host are at least min_interval seconds apart
+    these are the defaults, hosts can have their own (see set_policy) '''
     
-    # pastebin.com
-    if re_url_pastebin.fullmatch(link):
-        # get index of last / in the url
-        i = len(link)-1
-        while link[i] != '/': i -= 1
-        # construct link to raw pastebin data
-        link_raw = link[:i] + '/raw' + link[i:]
-        
-    # gist.github.com
-    elif re_url_gistgithub.fullmatch(link):
-        # first get the page that is linked
-        request = requests.get(link)
+    def __init__(self,min_interval=HOST_INTERVAL,
+                 max_connections=HOST_CONNECTIONS):
+        self.min_interval = min_interval
+        self.max_connections = max_connections
+        self.policies = dict() # host -> (min_interval, max_connections)
+        self.lock = threading.Lock()
+        self.slots = dict() # host -> semaphore
+        self.next_start = dict() # host -> earliest time for next request
+    
+    def set_policy(self,host,min_interval=None,max_connections=None):
+        ''' limits for 1 host (None to use the default), must be set before
+        the first request to the host '''
+        self.policies[host] = (min_interval,max_connections)
+    
+    def policy(self,host):
+        ''' returns (min_interval, max_connections) for the host '''
+        min_interval,max_connections = self.policies.get(host,(None,None))
+        return (self.min_interval if min_interval is None else min_interval,
+                self.max_connections if max_connections is None
+                else max_connections)
+    
+    def acquire(self,host):
+        min_interval,max_connections = self.policy(host)
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.Semaphore(max_connections)
+        self.slots[host].acquire()
+        with self.lock: # reserve a start time for this request
+            now = time.monotonic()
+            start = max(now,self.next_start.get(host,now))
+            self.next_start[host] = start+min_interval
+        if start > now:
+            time.sleep(start-now)
+    
+    def release(self,host):
+        self.slots[host].release()
+
+def make_session(workers=DOWNLOAD_WORKERS):
+    ''' http session with a connection pool large enough for all workers '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                                            pool_maxsize=workers)
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
+    return session
+
+# default number of times to retry a request after a transient error
+RETRIES = 4
+
+# seconds before the first retry, doubled for each retry after that
+BACKOFF = 1.0
+
+# maximum seconds to wait before a retry
+BACKOFF_MAX = 60.0
+
+# response status codes for errors that may go away when trying again
+TRANSIENT_STATUS = {429,500,502,503,504}
+
+def backoff_delay(attempt):
+    ''' seconds to wait before retrying after the given attempt (from 0)
+    exponential backoff with random jitter so threads do not retry together '''
+    return random.uniform(0,min(BACKOFF_MAX,BACKOFF*2**attempt))
+
+def http_get(url,session=None,limiter=None,headers=None,retries=None):
+    ''' GET request with the session and host limits (if given)
+    transient errors (connection errors, timeouts, TRANSIENT_STATUS responses)
+    are retried up to retries times (default RETRIES) with backoff_delay
+    between attempts, the result of the last attempt is returned (or raised) '''
+    if retries is None:
+        retries = RETRIES
+    host = urllib.parse.urlsplit(url).netloc
+    for attempt in range(retries+1):
+        if limiter is not None:
+            limiter.acquire(host)
+        try:
+            response = (session or requests).get(url,headers=headers,
+                                                 timeout=REQUEST_TIMEOUT)
+        except (requests.ConnectionError,requests.Timeout):
+            if attempt == retries:
+                raise
+            response = None
+        finally:
+            if limiter is not None:
+                limiter.release(host)
+        if response is not None and (attempt == retries or
+                response.status_code not in TRANSIENT_STATUS):
+            return response
+        time.sleep(backoff_delay(attempt))
+
+# default directory for the http response cache
+CACHE_DIR = 'amq_scraper.cache'
+
+# default seconds to remember that a url failed before trying it again
+DEAD_TTL = 24*60*60
+
+class ResponseCache:
+    ''' http responses saved on disk between runs, keyed by url
+    index.json maps url -> entry (dict) with some of these keys:
+    etag,last_modified: validators for a conditional request on the next fetch
+    body: file (in the cache directory) with the saved response text
+    raw: raw link found on a gist page (these include the gist revision so the
+         page does not need to be fetched again)
+    dead: time (seconds since epoch) until which the url is known to fail
+    bodies are written immediately, the index is written by save() '''
+    
+    def __init__(self,path=CACHE_DIR,dead_ttl=DEAD_TTL):
+        self.path = path
+        self.dead_ttl = dead_ttl
+        self.lock = threading.Lock()
+        os.makedirs(path,exist_ok=True)
+        try:
+            self.entries = json.loads(open(self.index_file(),'r').read())
+        except (OSError,ValueError):
+            self.entries = dict()
+    
+    def index_file(self):
+        return os.path.join(self.path,'index.json')
+    
+    def entry(self,url):
+        with self.lock:
+            return dict(self.entries.get(url,dict()))
+    
+    def update(self,url,**values):
+        with self.lock:
+            entry = self.entries.setdefault(url,dict())
+            entry.update(values)
+            for key in [key for key in entry if entry[key] is None]:
+                del entry[key]
+    
+    def is_dead(self,url):
+        return self.entry(url).get('dead',0) > time.time()
+    
+    def raw_link(self,url):
+        return self.entry(url).get('raw')
+    
+    def set_raw_link(self,url,raw):
+        self.update(url,raw=raw)
+    
+    def get(self,url,session=None,limiter=None):
+        ''' returns (ok, text) like a response from http_get
+        urls that failed within dead_ttl are not requested again (not ok with
+        text None), if the saved response is still valid (304 response to the
+        conditional request) the saved text is returned '''
+        entry = self.entry(url)
+        if entry.get('dead',0) > time.time():
+            return (False,None)
+        body = os.path.join(self.path,entry.get('body',''))
+        headers = dict()
+        if 'body' in entry and os.path.exists(body):
+            if 'etag' in entry:
+                headers['If-None-Match'] = entry['etag']
+            if 'last_modified' in entry:
+                headers['If-Modified-Since'] = entry['last_modified']
+        request = http_get(url,session,limiter,headers)
+        if request.status_code == 304 and headers:
+            return (True,open(body,'r',encoding='utf-8').read())
         if not request.ok:
-            return (False,'error extracting link to raw from url: "%s"'%link)
-        page = bs4.BeautifulSoup(request.text,'html.parser')
-        # find the buttons that link to the raws
-        raws = [a for a in page.find_all('a')
-                if a.text.lower().strip() == 'raw']
-        if len(raws) == 0:
-            return (False,'did not find a raw link on url: "%s"'%link)
-        # assume desired json is the first raw link
-#        if len(raws) != 1 or (not raws[0].has_attr('href')):
-#            return (False,'did not find exactly 1 raw link on url: "%s"'%link)
-        # get the href attribute that links to the raw json
-        link_raw = raws[0]['href']
-        # these href may be absolute on the server (starting with /)
-        if link_raw.startswith('/'):
-            link_raw = 'https://gist.github.com' + link_raw
-    
-    # unsupported
-    else:
+            # server errors and rate limits are temporary, try again next run
+            if request.status_code < 500 and request.status_code != 429:
+                self.update(url,dead=time.time()+self.dead_ttl)
+            return (False,request.text)
+        name = hashlib.sha1(url.encode()).hexdigest()
+        with open(os.path.join(self.path,name+'.tmp'),'w',
+                  encoding='utf-8') as f:
+            f.write(request.text)
+        os.replace(os.path.join(self.path,name+'.tmp'),
+                   os.path.join(self.path,name))
+        self.update(url,body=name,etag=request.headers.get('ETag'),
+                    last_modified=request.headers.get('Last-Modified'),
+                    dead=None)
+        return (True,request.text)
+    
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries)
+        with open(self.index_file()+'.tmp','w') as f:
+            f.write(data)
+        os.replace(self.index_file()+'.tmp',self.index_file())
+
+def fetch(url,session=None,limiter=None,cache=None):
+    ''' returns (ok, text) for a GET request, through the cache if given '''
+    if cache is not None:
+        return cache.get(url,session,limiter)
+    request = http_get(url,session,limiter)
+    return (request.ok,request.text)
+
+class SiteHandler:
+    ''' a site that songlist links can be on
+    pattern: regex matching the links to the site
+    resolve: function (link, session, limiter, cache) returning
+             (raw link, None) for the link or (None, error message)
+    hosts: hosts that requests for this site go to, interval and connections
+           are their limits (None for the HostLimiter defaults)
+    downloads for each site run in their own threads (see run_downloads) '''
+    
+    def __init__(self,name,pattern,resolve,hosts,interval=None,
+                 connections=None):
+        self.name = name
+        self.pattern = pattern
+        self.resolve = resolve
+        self.hosts = hosts
+        self.interval = interval
+        self.connections = connections
+
+def resolve_pastebin(link,session=None,limiter=None,cache=None):
+    # get index of last / in the url
+    i = len(link)-1
+    while link[i] != '/': i -= 1
+    # construct link to raw pastebin data
+    return (link[:i] + '/raw' + link[i:],None)
+
+def resolve_gist(link,session=None,limiter=None,cache=None):
+    # raw link already known
+    link_raw = cache.raw_link(link) if cache is not None else None
+    if link_raw is not None:
+        return (link_raw,None)
+    # first get the page that is linked
+    if cache is not None and cache.is_dead(link):
+        return (None,'known dead url (cached): "%s"'%link)
+    ok,text = fetch(link,session,limiter,cache)
+    if not ok:
+        return (None,'error extracting link to raw from url: "%s"'%link)
+    page = bs4.BeautifulSoup(text,'html.parser')
+    # find the buttons that link to the raws
+    raws = [a for a in page.find_all('a')
+            if a.text.lower().strip() == 'raw']
+    if len(raws) == 0:
+        return (None,'did not find a raw link on url: "%s"'%link)
+    # assume desired json is the first raw link
+#    if len(raws) != 1 or (not raws[0].has_attr('href')):
+#        return (None,'did not find exactly 1 raw link on url: "%s"'%link)
+    # get the href attribute that links to the raw json
+    link_raw = raws[0]['href']
+    # these href may be absolute on the server (starting with /)
+    if link_raw.startswith('/'):
+        link_raw = 'https://gist.github.com' + link_raw
+    if cache is not None:
+        cache.set_raw_link(link,link_raw)
+    return (link_raw,None)
+
+# sites that links can be downloaded from, add a SiteHandler to support more
+SITE_HANDLERS = \
+[
+    SiteHandler('pastebin',re_url_pastebin,resolve_pastebin,
+                ['pastebin.com','www.pastebin.com']),
+    SiteHandler('gist',re_url_gistgithub,resolve_gist,
+                ['gist.github.com','gist.githubusercontent.com'])
+]
+
+def find_handler(link):
+    ''' the SiteHandler for a link, None if unsupported '''
+    for handler in SITE_HANDLERS:
+        if handler.pattern.fullmatch(link.strip()):
+            return handler
+    return None
+
+def make_limiter(min_interval=HOST_INTERVAL,max_connections=HOST_CONNECTIONS):
+    ''' HostLimiter with the policies of the site handlers '''
+    limiter = HostLimiter(min_interval,max_connections)
+    for handler in SITE_HANDLERS:
+        for host in handler.hosts:
+            limiter.set_policy(host,handler.interval,handler.connections)
+    return limiter
+
+def download_url(link,session=None,limiter=None,cache=None):
+    ''' returns (success_bool, result_str)
+    if successful, result_str is json data, otherwise it is error message
+    the raw link is found by the SiteHandler for the link
+    session and limiter are used for the requests if given (see http_get)
+    responses and gist raw links are saved in the cache if given and failed
+    urls are skipped while they are known to be dead (see ResponseCache) '''
+    link = link.strip()
+    handler = find_handler(link)
+    if handler is None:
         return (False, 'unsupported url: "%s"'%link)
-        
+    link_raw,error = handler.resolve(link,session,limiter,cache)
+    if link_raw is None:
+        return (False,error)
+    
     # use link_raw to get the json data
-    request = requests.get(link_raw)
-    if request.ok:
-        return (True,request.text)
+    if cache is not None and cache.is_dead(link_raw):
+        return (False,'known dead url (cached): "%s"'%link_raw)
+    ok,text = fetch(link_raw,session,limiter,cache)
+    if ok:
+        return (True,text)
     else:
         return (False,'error fetching raw url: "%s"'%link_raw)
 
+# default file for the job journal
+JOURNAL_FILE = 'amq_scraper.journal'
+
+class JobJournal:
+    ''' status of each file (year, season, day, region) kept between runs
+    the journal file has 1 json object per line, appended when the status of a
+    file changes, the last line for a file is its current status
+    the journal is informational only: which files are downloaded on a rerun is
+    decided by which output files exist, the journal shows what each run did
+    and why files failed
+    when opened, the file is rewritten with only the last line of each file if
+    it has older lines, so it does not grow with every run '''
+    
+    def __init__(self,path=JOURNAL_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = dict() # (year,season,day,region) -> last record
+        lines = 0
+        if os.path.exists(path):
+            for line in open(path,'r'):
+                lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError: # partial line from an interrupted run
+                    continue
+                self.records[self.key(record)] = record
+        if lines > len(self.records): # compact
+            with open(path+'.tmp','w') as f:
+                for record in self.records.values():
+                    f.write(json.dumps(record)+'\n')
+            os.replace(path+'.tmp',path)
+        self.file = open(path,'a')
+    
+    @staticmethod
+    def key(record):
+        return (record['year'],record['season'],record['day'],
+                record['region'])
+    
+    def status(self,year,season,day,region):
+        record = self.records.get((year,season,day,region))
+        return record['status'] if record else None
+    
+    def record(self,year,season,day,region,filename,status,message=None):
+        ''' sets the status of a file (written only if it changed) '''
+        record = {'year':year,'season':season,'day':day,'region':region,
+                  'file':filename,'status':status}
+        if message is not None:
+            record['message'] = message
+        with self.lock:
+            old = self.records.get(self.key(record))
+            if old is not None and \
+                    {k:v for k,v in old.items() if k != 'time'} == record:
+                return
+            record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+            self.records[self.key(record)] = record
+            self.file.write(json.dumps(record)+'\n')
+            self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
 def json_valid(data):
     try:
         data = json.loads(data)
@@ -124,10 +510,12 @@ def json_fixer(data):
 
 REGIONS = ['east','central','west']
 
-def process_sheet(sheet):
+def sheet_jobs(sheet,output,summary,journal=None):
     ''' goes through the links in the sheet to collect the ranked data
-    if the file does not exist, it tries to download it
-    the validity of the json output is checked afterward'''
+    returns list of jobs (sheet, year, season, day, region, url, filename) for
+    the files that exist or have a link, with day 0 for the championship
+    files without a link are counted in summary (and recorded in the journal if
+    given), a row that cannot be parsed is reported and skipped '''
     print('='*40)
     print('===','processing file:',sheet)
     # extract sheet name
@@ -138,7 +526,8 @@ def process_sheet(sheet):
     sheet_match = re_sheet_name.fullmatch(sheet_file_name)
     if not sheet_match:
         print('===','ERROR file name does not match regex')
-        return
+        summary['sheet error'] += 1
+        return []
     year,season = sheet_match.groups()
     year,season = int(year),int(season)
     print('===','year:',year)
@@ -180,67 +569,534 @@ def process_sheet(sheet):
     
     print('processing files...')
     
+    jobs = [] # (sheet, year, season, day, region, url, filename)
+    
     # starting on row 2: expect day,date, then extract url with songlist_col
     for i in range(2,len(rows)):
-        day,date = rows[i][:2]
-        if day.strip().lower() == 'championship':
-            day = 0
-        else:
-            day = int(day)
-            assert day+1 == i, 'ranked day numbers in incorrect order'
-        m,d,y = re_date_mmddyyyy.fullmatch(date.strip()).groups()
-        m,d,y = int(m),int(d),int(y)
-        assert 1<=m<=12 and 1<=d<=31, 'invalid date: '+date.strip()
+        try:
+            jobs += row_jobs(sheet,output,summary,journal,year,season,
+                             rows[i],i,songlist_col)
+        except Exception as e:
+            print('===','ERROR parsing row %d of file "%s"'%(i+1,sheet))
+            print('===',type(e).__name__+':',str(e))
+            summary['row error'] += 1
+    
+    return jobs
+
+def row_jobs(sheet,output,summary,journal,year,season,row,i,songlist_col):
+    ''' jobs for row i of a sheet (see sheet_jobs) '''
+    jobs = []
+    day,date = row[:2]
+    if day.strip().lower() == 'championship':
+        day = 0
+    else:
+        day = int(day)
+        assert day+1 == i, 'ranked day numbers in incorrect order'
+    m,d,y = re_date_mmddyyyy.fullmatch(date.strip()).groups()
+    m,d,y = int(m),int(d),int(y)
+    assert 1<=m<=12 and 1<=d<=31, 'invalid date: '+date.strip()
+    
+    # process each region for this date
+    for region in songlist_col:
+        filename = 'amq_%ds%02d_%s_%d-%02d-%02d_%s.json' \
+                    %(year,season,'ch' if day == 0 else '%02d'%day,
+                        y,m,d,region)
         
-        # process each region for this date
-        for region in songlist_col:
-            filename = 'amq_%ds%02d_%s_%d-%02d-%02d_%s.json' \
-                        %(year,season,'ch' if day == 0 else '%02d'%day,
-                            y,m,d,region)
-            
-            # if file is downloaded, check json
-            if os.path.exists(outdir+'/'+filename):
-                data = open(outdir+'/'+filename,'r').read()
-                if json_valid(data):
-                    redump = json.dumps(json.loads(data),indent=4)
-                    if redump != data: # rewrite file with json reformatted
-                        file = open(outdir+'/'+filename,'w')
-                        file.write(redump)
-                        file.close()
-                        print('exists,reformatted:',filename)
-                    else:
-                        print('exists,done:',filename)
-                else:
-                    success,data = json_fixer(data)
-                    if success:
-                        print('exists,done:',filename)
-                    else:
-                        print('JSON ERROR:',filename)
-                continue
-            
-            # download nonexisting file if available
-            url = rows[i][songlist_col[region]].strip()
-            if url == '':
-                print('not available:',filename)
-                continue
-            success,result = download_url(url)
-            if not success:
-                print('FAILED DOWNLOAD:',filename,'MESSAGE:',result)
+        # download nonexisting file if available (existing files are checked
+        # later by check_existing)
+        url = row[songlist_col[region]].strip()
+        if url == '' and not output.exists(filename):
+            print('not available:',filename)
+            report(summary,journal,year,season,day,region,filename,
+                   'not available')
+            continue
+        jobs.append((sheet,year,season,day,region,url,filename))
+    
+    return jobs
+
+def report(summary,journal,year,season,day,region,filename,status,
+           message=None):
+    ''' counts the status of a file in summary and records it in journal '''
+    summary[status] += 1
+    if journal is not None:
+        journal.record(year,season,day,region,filename,status,message)
+
+# compression for --archive=<name>
+ARCHIVE_COMPRESSION = \
+{
+    'deflate': zipfile.ZIP_DEFLATED,
+    'lzma': zipfile.ZIP_LZMA,
+    'bzip2': zipfile.ZIP_BZIP2
+}
+
+# default number of downloaded files kept in memory for an archive before
+# it is rewritten with them
+ARCHIVE_BATCH = 16
+
+class FileOutput:
+    ''' output as loose json files in a directory
+    files are written as json with indent=4, or without whitespace if compact
+    (see dumps) '''
+    
+    def __init__(self,outdir,compact=False):
+        self.outdir = outdir
+        self.compact = compact
+        self.format = 'compact' if compact else 'indent'
+    
+    def dumps(self,obj):
+        ''' the normalized json text for the data in a file '''
+        if self.compact:
+            return json.dumps(obj,separators=(',',':'))
+        return json.dumps(obj,indent=4)
+    
+    def path(self,filename):
+        return self.outdir+'/'+filename
+    
+    def key(self,filename):
+        ''' identifies the file in the validated files list '''
+        return os.path.abspath(self.path(filename))
+    
+    def exists(self,filename):
+        return os.path.exists(self.path(filename))
+    
+    def stat(self,filename):
+        ''' [size, version] where version changes when the file is written '''
+        stat = os.stat(self.path(filename))
+        return [stat.st_size,stat.st_mtime_ns]
+    
+    def read(self,filename):
+        return open(self.path(filename),'rb').read()
+    
+    def write(self,filename,text):
+        # write to a temporary file first so an interrupted run never leaves a
+        # partial file that would be taken as already downloaded
+        path = self.path(filename)
+        try:
+            with open(path+'.tmp','w') as file:
+                file.write(text)
+            os.replace(path+'.tmp',path)
+        finally:
+            if os.path.exists(path+'.tmp'):
+                os.remove(path+'.tmp')
+    
+    def flush(self):
+        pass
+
+class ArchiveOutput(FileOutput):
+    ''' output as members of per season zip archives in a directory
+    <output dir>/amq_<year>s<season>.zip with the files in a amq_<year>s<season>
+    directory inside, the same as the ranked_data_zip archives (so the loader
+    can read them directly)
+    written files are kept in memory and added to the archive in batches, an
+    archive is updated by writing a new archive and replacing the old one so
+    it is never left partially written
+    compression is a zipfile constant (ZIP_DEFLATED, ZIP_LZMA, ZIP_BZIP2) '''
+    
+    def __init__(self,outdir,compact=False,compression=zipfile.ZIP_DEFLATED,
+                 batch=ARCHIVE_BATCH):
+        super().__init__(outdir,compact)
+        self.compression = compression
+        self.batch = batch
+        self.infos = dict() # archive -> map member name -> ZipInfo
+        self.pending = dict() # archive -> map member name -> text
+    
+    def __getstate__(self): # for reading in other processes
+        state = dict(self.__dict__)
+        state['infos'] = dict()
+        state['pending'] = dict()
+        return state
+    
+    def path(self,filename):
+        ''' (archive path, member name) for a file '''
+        season = re.match(r'amq_\d{4}s\d\d',filename).group()
+        return (os.path.join(self.outdir,season+'.zip'),season+'/'+filename)
+    
+    def key(self,filename):
+        archive,member = self.path(filename)
+        return os.path.abspath(archive)+'/'+member
+    
+    def members(self,archive):
+        if archive not in self.infos:
+            self.infos[archive] = dict()
+            if os.path.exists(archive):
+                with zipfile.ZipFile(archive,'r') as z:
+                    self.infos[archive] = {info.filename: info
+                                           for info in z.infolist()}
+        return self.infos[archive]
+    
+    def exists(self,filename):
+        archive,member = self.path(filename)
+        return member in self.pending.get(archive,dict()) or \
+               member in self.members(archive)
+    
+    def stat(self,filename):
+        ''' [size, crc32] of the member '''
+        archive,member = self.path(filename)
+        if member in self.pending.get(archive,dict()):
+            data = self.pending[archive][member].encode()
+            return [len(data),zlib.crc32(data)]
+        info = self.members(archive)[member]
+        return [info.file_size,info.CRC]
+    
+    def read(self,filename):
+        archive,member = self.path(filename)
+        if member in self.pending.get(archive,dict()):
+            return self.pending[archive][member].encode()
+        with zipfile.ZipFile(archive,'r') as z:
+            return z.read(member)
+    
+    def write(self,filename,text):
+        archive,member = self.path(filename)
+        self.pending.setdefault(archive,dict())[member] = text
+        if len(self.pending[archive]) >= self.batch:
+            self.flush_archive(archive)
+    
+    def flush(self):
+        for archive in list(self.pending):
+            self.flush_archive(archive)
+    
+    def flush_archive(self,archive):
+        ''' writes the pending files to the archive '''
+        updates = self.pending.pop(archive)
+        members = self.members(archive)
+        tmp = archive+'.tmp'
+        try:
+            if members and not any(member in members for member in updates):
+                # only new members, append them to a copy
+                shutil.copyfile(archive,tmp)
+                mode = 'a'
             else:
-                success,result = json_fixer(result)
-                file = open(outdir+'/'+filename,'w')
-                if success:
-                    file.write(json.dumps(json.loads(result),indent=4))
-                    print('success:',filename)
-                else:
-                    file.write(result)
-                    print('JSON ERROR:',filename)
-                file.close()
-
-try:
-    process_sheet(sheet)
-    print('===','DONE')
-except Exception as e:
-    print('===','ERROR parsing file "%s"'%sheet)
-    print('===',type(e).__name__+':',str(e))
+                mode = 'w'
+            with zipfile.ZipFile(tmp,mode,self.compression) as z:
+                if mode == 'w' and members:
+                    # replaced members, copy the others to a new archive
+                    with zipfile.ZipFile(archive,'r') as old:
+                        for info in old.infolist():
+                            if info.filename not in updates:
+                                z.writestr(info,old.read(info))
+                elif mode == 'w': # new archive, starts with the directory
+                    z.writestr(os.path.dirname(next(iter(updates)))+'/','')
+                for member in sorted(updates):
+                    z.writestr(member,updates[member])
+            os.replace(tmp,archive)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        del self.infos[archive]
 
+# default file for the list of validated files
+VALIDATED_FILE = 'amq_scraper.validated.json'
+
+class ValidatedFiles:
+    ''' downloaded files known to be valid json in the normalized format
+    (see FileOutput.dumps), so they do not need to be parsed again
+    maps file key -> [size, version, sha1 of contents, format] (see
+    FileOutput.key and FileOutput.stat)
+    a file with the same size and version is skipped without reading it, if
+    only the version changed it is read to compare the hash '''
+    
+    def __init__(self,path=VALIDATED_FILE):
+        self.path = path
+        try:
+            self.files = json.loads(open(path,'r').read())
+        except (OSError,ValueError):
+            self.files = dict()
+    
+    def get(self,output,filename):
+        ''' returns (unchanged, sha1) with unchanged True if the file has the
+        size and version it had when validated, sha1 is None if not validated
+        in the format of the output '''
+        entry = self.files.get(output.key(filename))
+        if entry is None or entry[3:] != [output.format]:
+            return (False,None)
+        return (output.stat(filename) == entry[:2],entry[2])
+    
+    def add(self,output,filename,sha1):
+        self.files[output.key(filename)] = output.stat(filename)+[sha1,
+                                                                output.format]
+    
+    def remove(self,output,filename):
+        self.files.pop(output.key(filename),None)
+    
+    def save(self):
+        with open(self.path+'.tmp','w') as f:
+            f.write(json.dumps(self.files))
+        os.replace(self.path+'.tmp',self.path)
+
+def check_file(output,filename,sha1=None):
+    ''' checks the json of an existing file
+    if the contents have the given sha1 (already validated) it is not parsed
+    returns (status, sha1 of the contents, normalized text to write or None)
+    with status one of unchanged, done, reformatted, json error '''
+    contents = output.read(filename)
+    digest = hashlib.sha1(contents).hexdigest()
+    if digest == sha1:
+        return ('unchanged',digest,None)
+    try:
+        data = contents.decode()
+        redump = output.dumps(json.loads(data))
+    except ValueError: # includes UnicodeDecodeError
+        success,data = json_fixer(contents.decode(errors='replace'))
+        return ('done' if success else 'json error',digest,None)
+    if redump == data:
+        return ('done',digest,None)
+    return ('reformatted',hashlib.sha1(redump.encode()).hexdigest(),redump)
+
+def check_existing(jobs,output,summary,journal=None,validated=None,
+                   workers=None):
+    ''' checks the files that already exist for the jobs (see check_file)
+    files in validated (if given) that did not change are not read, the others
+    are checked in parallel by workers processes (None for os.cpu_count())
+    and the valid ones are added to validated, files that are not in the
+    normalized format are rewritten
+    returns the jobs for the files that do not exist '''
+    existing = [job for job in jobs if output.exists(job[6])]
+    downloads = [job for job in jobs if not output.exists(job[6])]
+    to_check = [] # (job, sha1 from validated)
+    for job in existing:
+        unchanged,sha1 = validated.get(output,job[6]) \
+                         if validated is not None else (False,None)
+        if unchanged:
+            print('exists,done:',job[6])
+            report(summary,journal,*job[1:5],job[6],'exists')
+        else:
+            to_check.append((job,sha1))
+    filenames = [job[6] for job,sha1 in to_check]
+    sha1s = [sha1 for job,sha1 in to_check]
+    if len(to_check) > 1 and workers != 1:
+        workers = min(workers or os.cpu_count() or 1,len(to_check))
+        chunksize = max(1,len(filenames)//(4*workers))
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(check_file,[output]*len(filenames),
+                                        filenames,sha1s,chunksize=chunksize))
+    else:
+        results = [check_file(output,filename,sha1)
+                   for filename,sha1 in zip(filenames,sha1s)]
+    for (job,sha1),(status,digest,redump) in zip(to_check,results):
+        filename = job[6]
+        if status == 'json error':
+            print('JSON ERROR:',filename)
+            if validated is not None:
+                validated.remove(output,filename)
+            report(summary,journal,*job[1:5],filename,'json error')
+            continue
+        if status == 'reformatted': # rewrite file with json reformatted
+            output.write(filename,redump)
+            print('exists,reformatted:',filename)
+        else:
+            print('exists,done:',filename)
+        if validated is not None:
+            validated.add(output,filename,digest)
+        report(summary,journal,*job[1:5],filename,'exists')
+    return downloads
+
+def run_downloads(jobs,output,summary,workers=DOWNLOAD_WORKERS,session=None,
+                  limiter=None,cache=None,journal=None,validated=None):
+    ''' downloads the files for the jobs (from sheet_jobs)
+    each distinct url is downloaded once, if several jobs have the same url the
+    result is written to all of their files
+    downloads run in a pool of worker threads (using session and limiter for
+    the requests), results are checked and written as they finish
+    the response cache (if given) is saved at the end
+    jobs are recorded as pending in the journal (if given) before starting and
+    with their result when done, files downloaded successfully are added to
+    validated (if given)'''
+    if session is None:
+        session = make_session(workers)
+    if limiter is None:
+        limiter = make_limiter()
+    targets = dict() # map url -> jobs to write its result to
+    for job in jobs:
+        url,filename = job[5:]
+        if url in targets:
+            print('duplicate url:',filename,'same as',targets[url][0][6])
+            summary['duplicate url'] += 1
+            targets[url].append(job)
+        else:
+            targets[url] = [job]
+    print('='*40)
+    print('===','downloading %d files (%d urls)'%(len(jobs),len(targets)))
+    if journal is not None:
+        unfinished = sum(journal.status(*job[1:5]) in ['pending',
+                         'failed download'] for job in jobs)
+        if unfinished:
+            print('===','%d of them were pending or failed in the journal'
+                  %unfinished)
+        for sheet,year,season,day,region,url,filename in jobs:
+            journal.record(year,season,day,region,filename,'pending')
+    # download in parallel, each site in its own threads so a slow site does
+    # not take the threads of the others, results are handled in this thread as
+    # they finish
+    try:
+        with contextlib.ExitStack() as stack:
+            executors = dict() # site handler -> thread pool
+            futures = dict() # future -> url
+            for url in targets:
+                handler = find_handler(url)
+                if handler not in executors:
+                    executors[handler] = stack.enter_context(
+                        concurrent.futures.ThreadPoolExecutor(workers))
+                future = executors[handler].submit(download_url,url,session,
+                                                   limiter,cache)
+                futures[future] = url
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+                # any error fails only this url, not the rest of the run
+                try:
+                    success,result = future.result()
+                except Exception as e:
+                    success,result = False,'%s: %s'%(type(e).__name__,e)
+                for sheet,year,season,day,region,url,filename in targets[url]:
+                    message = None if success else result
+                    try:
+                        status = write_download(output,filename,success,result)
+                        if status == 'success' and validated is not None:
+                            validated.add(output,filename,hashlib.sha1(
+                                output.read(filename)).hexdigest())
+                    except Exception as e:
+                        message = '%s: %s'%(type(e).__name__,e)
+                        print('FAILED DOWNLOAD:',filename,'MESSAGE:',message)
+                        status = 'failed download'
+                    report(summary,journal,year,season,day,region,filename,
+                           status,message)
+    finally:
+        if cache is not None:
+            cache.save()
+
+def write_download(output,filename,success,result):
+    ''' writes a downloaded file (result from download_url)
+    returns the status for the summary '''
+    if not success:
+        print('FAILED DOWNLOAD:',filename,'MESSAGE:',result)
+        return 'failed download'
+    success,result = json_fixer(result)
+    if success:
+        result = output.dumps(json.loads(result))
+    output.write(filename,result)
+    print(('success:' if success else 'JSON ERROR:'),filename)
+    return 'success' if success else 'json error'
+
+def find_sheets(paths):
+    ''' expands directories in paths to the sheet csv files in them (with names
+    matching re_sheet_name, sorted), other paths are kept as given '''
+    sheets = []
+    for path in paths:
+        if os.path.isdir(path):
+            sheets += sorted(os.path.join(path,name)
+                             for name in os.listdir(path)
+                             if re_sheet_name.fullmatch(name))
+        else:
+            sheets.append(path)
+    return sheets
+
+def process_sheets(sheets,outdir,workers=DOWNLOAD_WORKERS,session=None,
+                   limiter=None,cache=None,journal=None,validated=None,
+                   check_workers=None):
+    ''' processes the sheets (files or directories of sheets) together
+    existing files are checked first (see check_existing, using validated and
+    check_workers), then the jobs from all the sheets go through 1 download
+    pool (see run_downloads)
+    outdir is the output directory for loose files or an output object (like
+    ArchiveOutput)
+    a sheet that cannot be parsed is reported and skipped
+    the status of each file is recorded in the journal if given
+    returns the summary, a Counter of the status of each file '''
+    output = FileOutput(outdir) if isinstance(outdir,str) else outdir
+    summary = collections.Counter()
+    jobs = []
+    for sheet in find_sheets(sheets):
+        try:
+            jobs += sheet_jobs(sheet,output,summary,journal)
+        except Exception as e:
+            print('===','ERROR parsing file "%s"'%sheet)
+            print('===',type(e).__name__+':',str(e))
+            summary['sheet error'] += 1
+    try:
+        jobs = check_existing(jobs,output,summary,journal,validated,
+                              check_workers)
+        run_downloads(jobs,output,summary,workers,session,limiter,cache,
+                      journal,validated)
+    finally:
+        output.flush()
+        if validated is not None:
+            validated.save()
+    return summary
+
+def process_sheet(sheet,outdir,workers=DOWNLOAD_WORKERS,session=None,
+                  limiter=None,cache=None,journal=None,validated=None,
+                  check_workers=None):
+    ''' processes 1 sheet (see process_sheets) '''
+    return process_sheets([sheet],outdir,workers,session,limiter,cache,
+                          journal,validated,check_workers)
+
+def print_summary(summary):
+    print('='*40)
+    print('===','SUMMARY')
+    for status in ['success','failed download','json error','exists',
+                   'not available','duplicate url','sheet error',
+                   'row error']:
+        print('===','%s: %d'%(status,summary[status]))
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    # --name=value or --name (value is empty string)
+    options = dict((arg[2:].split('=',1)+[''])[:2] for arg in sys.argv[1:]
+                   if arg.startswith('--'))
+    
+    if len(args) < 2:
+        print('usage: amq_scraper.py <sheet csv or dir>... <output dir> '
+              '[options]')
+        quit()
+    
+    archive = options.get('archive')
+    if archive and archive not in ARCHIVE_COMPRESSION:
+        print('unknown archive compression "%s", use one of: %s'
+              %(archive,', '.join(ARCHIVE_COMPRESSION)))
+        quit()
+    
+    # sheet data to process
+    sheets = args[:-1]
+    
+    # dir to store output in
+    outdir = os.path.normpath(args[-1])
+    
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+    
+    workers = int(options.get('workers',DOWNLOAD_WORKERS))
+    limiter = make_limiter(
+        float(options.get('interval',HOST_INTERVAL)),
+        int(options.get('host-connections',HOST_CONNECTIONS)))
+    
+    cache = None
+    if options.get('cache','') != 'none':
+        cache = ResponseCache(options.get('cache',CACHE_DIR),
+                              float(options.get('dead-ttl',DEAD_TTL/3600))*3600)
+    
+    RETRIES = int(options.get('retries',RETRIES))
+    
+    journal = None
+    if options.get('journal','') != 'none':
+        journal = JobJournal(options.get('journal',JOURNAL_FILE))
+    
+    validated = None
+    if options.get('validated','') != 'none':
+        validated = ValidatedFiles(options.get('validated',VALIDATED_FILE))
+    check_workers = options.get('check-workers')
+    check_workers = int(check_workers) if check_workers else None
+    
+    compact = 'compact' in options
+    if archive is not None:
+        compression = ARCHIVE_COMPRESSION[archive or 'deflate']
+        output = ArchiveOutput(outdir,compact,compression)
+    else:
+        output = FileOutput(outdir,compact)
+    
+    try:
+        summary = process_sheets(sheets,output,workers,make_session(workers),
+                                 limiter,cache,journal,validated,check_workers)
+    finally:
+        if journal is not None:
+            journal.close()
+    print_summary(summary)
+    print('===','DONE')
@@ -0,0 +1,528 @@
+'''
+Columnar (NumPy) representation of the cleaned ranked data from amq_loader.
+
+Instead of 1 dict per song, every song attribute is stored as an array with 1
+entry per song (a row). Number attributes are stored directly and string
+attributes are dictionary encoded as indexes into a single string table, so the
+many repeated strings (type, artist, anime names, ...) are only stored once.
+The match information (region, year, season, number, date) is stored with 1
+entry per match, and each row has the index of the match it belongs to.
+
+Row columns:
+match       int32   index of the match the song is in
+correct     int32   correct guess count
+players     int32   active player count
+start       int32   sample start, -1 for null
+length      float64 song length, NaN for null
+length_int  bool    true if the length was stored as an integer
+animeEng, animeRomaji, songName, artist, type, linkWebm, linkMp3
+            int32   index in the string table, -1 for null
+raw         int32   index in the string table of the song as JSON text if it
+                    could not be cleaned by amq_loader (-1 for cleaned songs)
+
+Match columns:
+region      int32   index in the string table
+year, season, number
+            int32   same as the ranked objects from amq_loader
+date        int32   date as the number YYYYMMDD
+offsets     int64   rows of match i are offsets[i] to offsets[i+1]
+
+Songs that were not cleaned keep the other row columns at null values and are
+never matched by queries, but they are kept so the conversion back to the list
+of dicts format gives exactly the data it was created from.
+
+The dataset can be saved to a cache directory with 1 .npy file per column, the
+string table as 2 arrays (strings_blob.npy and strings_offsets.npy) and a
+manifest.json file. The manifest has the cache format version and the input
+files the data was loaded from (see amq_loader.read_ranked_columns). When
+loading, the arrays are memory mapped so only the parts that are used get read.
+
+Requires numpy.
+'''
+
+import json
+import numpy as np
+import os
+
+import amq_loader
+
+# Key order of cleaned songs
+SONG_ATTRS = list(amq_loader.attr_mapping)
+
+# Song attributes stored as codes in the string table
+STRING_COLUMNS = \
+[
+    'animeEng',
+    'animeRomaji',
+    'songName',
+    'artist',
+    'type',
+    'linkWebm',
+    'linkMp3'
+]
+
+# Version of the cache format, caches with a different version are not loaded
+CACHE_VERSION = 2
+
+# Columns with 1 entry per song
+ROW_COLUMNS = \
+[
+    'match',
+    'correct',
+    'players',
+    'start',
+    'length',
+    'length_int',
+    *STRING_COLUMNS,
+    'raw'
+]
+
+# Columns with 1 entry per match (offsets has 1 extra entry)
+MATCH_COLUMNS = \
+[
+    'region',
+    'year',
+    'season',
+    'number',
+    'date',
+    'offsets'
+]
+
+# Data type of each column (int32 if not listed)
+COLUMN_DTYPES = \
+{
+    'length': np.float64,
+    'length_int': np.bool_,
+    'offsets': np.int64
+}
+
+class StringTable:
+    '''
+    List of strings stored as a UTF-8 byte array with the offset of each string
+    (string i is blob[offsets[i]:offsets[i+1]]). Strings are only decoded when
+    they are accessed, so the arrays may be memory mapped from a file.
+    '''
+
+    def __init__(self, blob, offsets, strings=None):
+        self.blob = blob
+        self.offsets = offsets
+        self._strings = strings
+
+    @staticmethod
+    def from_list(strings):
+        encoded = [s.encode() for s in strings]
+        offsets = np.zeros(len(encoded)+1,dtype=np.int64)
+        np.cumsum([len(b) for b in encoded],out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded),dtype=np.uint8)
+        return StringTable(blob,offsets,list(strings))
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, i):
+        if self._strings is not None:
+            return self._strings[i]
+        return bytes(self.blob[self.offsets[i]:self.offsets[i+1]]).decode()
+
+    def strings(self):
+        ''' All strings in the table (decoded once, then kept) '''
+        if self._strings is None:
+            blob = bytes(self.blob)
+            offsets = self.offsets.tolist()
+            self._strings = [blob[offsets[i]:offsets[i+1]].decode()
+                             for i in range(len(offsets)-1)]
+        return self._strings
+
+class RankedColumns:
+    '''
+    Columnar ranked dataset. Columns are accessed by name, for example
+    cols['correct'], and the string table is cols.strings.
+    '''
+
+    def __init__(self, columns, strings):
+        self.columns = columns
+        self.strings = strings
+        # (match order by date, sorted dates), set together so that threads
+        # sharing the columns never see half of it
+        self._date_index = None
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def num_rows(self):
+        return len(self.columns['match'])
+
+    def num_matches(self):
+        return len(self.columns['date'])
+
+    def column(self, name, rows=None):
+        '''
+        Values of a column for the given rows (a slice or array of row indexes,
+        all rows if None). Slices of memory mapped columns are not copied.
+        '''
+        if rows is None:
+            return self.columns[name]
+        return self.columns[name][rows]
+
+    def valid(self, rows=None):
+        ''' Mask of rows with cleaned songs '''
+        return self.column('raw',rows) == -1
+
+    def ratio(self, rows=None):
+        ''' correct/players for each row (NaN for songs that are not cleaned) '''
+        players = self.column('players',rows)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return np.where(players > 0,
+                            self.column('correct',rows)/np.maximum(players,1),
+                            np.nan)
+
+    def date_rows(self, after, before):
+        '''
+        Rows of the matches with after < date < before (dates as YYYYMMDD
+        numbers), found by binary search on the matches sorted by date. Returns
+        a slice if the rows are contiguous (the matches are normally in date
+        order), otherwise an array of row indexes in increasing order.
+        '''
+        if self._date_index is None:
+            order = np.argsort(self.columns['date'],kind='stable')
+            self._date_index = (order,self.columns['date'][order])
+        order,sorted_dates = self._date_index
+        lo = np.searchsorted(sorted_dates,after,'right')
+        hi = np.searchsorted(sorted_dates,before,'left')
+        matches = np.sort(order[lo:hi])
+        offsets = self.columns['offsets']
+        if len(matches) == 0:
+            return slice(0,0)
+        if matches[-1]-matches[0] == len(matches)-1: # contiguous
+            return slice(int(offsets[matches[0]]),int(offsets[matches[-1]+1]))
+        match_mask = np.zeros(self.num_matches(),dtype=np.bool_)
+        match_mask[matches] = True
+        return np.flatnonzero(np.repeat(match_mask,np.diff(offsets)))
+
+    def string_column(self, name, rows=None):
+        ''' Decoded values of a string column (None for null) '''
+        codes = self.columns[name]
+        if rows is not None:
+            codes = codes[rows]
+        strings = self.strings.strings()
+        return [None if code < 0 else strings[code]
+                for code in codes.tolist()]
+
+    def string_mask(self, name, predicate, lower=False, rows=None):
+        '''
+        Mask of rows where the string column satisfies the predicate. The
+        predicate is evaluated once per distinct string rather than per row.
+        Null values never satisfy the predicate.
+        '''
+        codes = self.column(name,rows)
+        distinct = np.unique(codes[codes >= 0]).tolist()
+        values = [self.strings[code] for code in distinct]
+        if lower:
+            values = [s.lower() for s in values]
+        satisfied = np.zeros(len(self.strings)+1,dtype=np.bool_) # -1 is last
+        satisfied[distinct] = [predicate(s) for s in values]
+        return satisfied[codes]
+
+    def match_info(self, i):
+        ''' Ranked object for match i from amq_loader, without the data '''
+        date = int(self.columns['date'][i])
+        return {
+            'region': self.strings[int(self.columns['region'][i])],
+            'year': int(self.columns['year'][i]),
+            'season': int(self.columns['season'][i]),
+            'number': int(self.columns['number'][i]),
+            'date': '%04d-%02d-%02d'%(date//10000,date//100%100,date%100)
+        }
+
+    def song(self, i):
+        ''' Song dict for row i in the format from clean_ranked_data '''
+        return self.songs([i])[0]
+
+    def songs(self, rows):
+        ''' Song dicts for the given rows (array or list of row indexes) '''
+        rows = np.asarray(rows,dtype=np.int64)
+        cols = self.columns
+        values = \
+            {name: self.string_column(name,rows) for name in STRING_COLUMNS}
+        values['correct'] = cols['correct'][rows].tolist()
+        values['players'] = cols['players'][rows].tolist()
+        values['start'] = [None if start < 0 else start
+                           for start in cols['start'][rows].tolist()]
+        values['length'] = [None if length != length # NaN
+                            else int(length) if is_int else length
+                            for length,is_int in
+                            zip(cols['length'][rows].tolist(),
+                                cols['length_int'][rows].tolist())]
+        raws = cols['raw'][rows].tolist()
+        strings = self.strings.strings()
+        result = []
+        for j,raw in enumerate(raws):
+            if raw >= 0:
+                result.append(json.loads(strings[raw]))
+            else:
+                result.append({attr: values[attr][j] for attr in SONG_ATTRS})
+        return result
+
+    def to_ranked_data(self):
+        ''' Converts back to the list of dicts format from amq_loader '''
+        songs = self.songs(np.arange(self.num_rows()))
+        offsets = self.columns['offsets'].tolist()
+        data = []
+        for i in range(self.num_matches()):
+            match = self.match_info(i)
+            match['data'] = songs[offsets[i]:offsets[i+1]]
+            data.append(match)
+        return data
+
+def is_cleaned(song):
+    '''
+    Checks if a song has exactly the format produced by clean_ranked_data, so it
+    can be stored in the typed columns.
+    '''
+    if type(song) != dict or list(song) != SONG_ATTRS:
+        return False
+    if any(song[attr] is not None and type(song[attr]) != str
+           for attr in STRING_COLUMNS):
+        return False
+    if type(song['correct']) != int or type(song['players']) != int:
+        return False
+    if song['start'] is not None and \
+            (type(song['start']) != int or song['start'] < 0):
+        return False
+    return song['length'] is None or type(song['length']) in (int,float)
+
+def from_ranked_data(data, base=None):
+    '''
+    Creates the columnar dataset from the output of amq_loader.read_ranked_data
+    (the data should be cleaned). If a base string table is given, the new
+    string table starts with its strings so the codes of a dataset using the
+    base table stay valid (for combining them).
+    '''
+    codes = dict() # string table being built
+    if base is not None:
+        codes = {s: i for i,s in enumerate(base.strings())}
+    def encode(s):
+        if s is None:
+            return -1
+        if s not in codes:
+            codes[s] = len(codes)
+        return codes[s]
+    rows = {name: [] for name in ROW_COLUMNS}
+    matches = {name: [] for name in MATCH_COLUMNS}
+    matches['offsets'].append(0)
+    for i,match in enumerate(data):
+        matches['region'].append(encode(match['region']))
+        matches['year'].append(match['year'])
+        matches['season'].append(match['season'])
+        matches['number'].append(match['number'])
+        matches['date'].append(int(match['date'].replace('-','')))
+        for song in match['data']:
+            rows['match'].append(i)
+            if not is_cleaned(song):
+                rows['correct'].append(0)
+                rows['players'].append(0)
+                rows['start'].append(-1)
+                rows['length'].append(np.nan)
+                rows['length_int'].append(False)
+                for name in STRING_COLUMNS:
+                    rows[name].append(-1)
+                rows['raw'].append(encode(json.dumps(song)))
+                continue
+            rows['correct'].append(song['correct'])
+            rows['players'].append(song['players'])
+            rows['start'].append(-1 if song['start'] is None
+                                 else song['start'])
+            rows['length'].append(np.nan if song['length'] is None
+                                  else song['length'])
+            rows['length_int'].append(type(song['length']) == int)
+            for name in STRING_COLUMNS:
+                rows[name].append(encode(song[name]))
+            rows['raw'].append(-1)
+        matches['offsets'].append(len(rows['match']))
+    columns = {name: np.array(values,dtype=COLUMN_DTYPES.get(name,np.int32))
+               for name,values in {**rows,**matches}.items()}
+    return RankedColumns(columns,StringTable.from_list(list(codes)))
+
+def combine(pieces, strings):
+    '''
+    Concatenates the matches start to end (exclusive) from each given dataset.
+    The string codes of all the datasets must refer to the given string table.
+    '''
+    parts = {name: [] for name in ROW_COLUMNS+MATCH_COLUMNS}
+    parts['offsets'].append(np.zeros(1,dtype=np.int64))
+    num_matches,num_rows = 0,0
+    for cols,start,end in pieces:
+        lo,hi = int(cols['offsets'][start]),int(cols['offsets'][end])
+        for name in ROW_COLUMNS:
+            parts[name].append(cols[name][lo:hi])
+        parts['match'][-1] = parts['match'][-1]-start+num_matches
+        for name in MATCH_COLUMNS[:-1]:
+            parts[name].append(cols[name][start:end])
+        parts['offsets'].append(cols['offsets'][start+1:end+1]-lo+num_rows)
+        num_matches += end-start
+        num_rows += hi-lo
+    columns = {name: np.concatenate(arrays or [np.zeros(0)])
+                        .astype(COLUMN_DTYPES.get(name,np.int32))
+               for name,arrays in parts.items()}
+    return RankedColumns(columns,strings)
+
+def describe(cols, mask=None):
+    '''
+    Basic statistics of the songs selected by mask (all cleaned songs if no
+    mask is given), computed with vectorized operations.
+    '''
+    if mask is None:
+        mask = cols.valid()
+    ratio = cols.ratio()[mask]
+    players = cols['players'][mask]
+    return {
+        'songs': int(len(ratio)),
+        'matches': int(len(np.unique(cols['match'][mask]))),
+        'ratioMean': float(ratio.mean()) if len(ratio) else None,
+        'ratioMedian': float(np.median(ratio)) if len(ratio) else None,
+        'playersMin': int(players.min()) if len(players) else None,
+        'playersMax': int(players.max()) if len(players) else None
+    }
+
+# Attributes that can be used to group rows in group_by
+GROUP_KEYS = STRING_COLUMNS+['region','year','season','date']
+
+def group_key(cols, key, rows):
+    ''' Integer values identifying the groups for 1 key in GROUP_KEYS '''
+    if key in STRING_COLUMNS:
+        return cols[key][rows]
+    matches = cols['match'][rows]
+    if key == 'season': # ranked season like 2021s05 as the number 202105
+        return cols['year'][matches].astype(np.int64)*100 \
+            + cols['season'][matches]
+    return cols[key][matches]
+
+def group_value(cols, key, value):
+    ''' Converts a value from group_key back to the attribute value '''
+    if key in STRING_COLUMNS or key == 'region':
+        return None if value < 0 else cols.strings[value]
+    if key == 'season':
+        return '%ds%02d'%(value//100,value%100)
+    if key == 'date':
+        return '%04d-%02d-%02d'%(value//10000,value//100%100,value%100)
+    return value
+
+def group_by(cols, keys, rows=None):
+    '''
+    Groups the given rows (all cleaned songs if None) by the keys (from
+    GROUP_KEYS) and computes for each group the same statistics as describe,
+    plus "frequency" which is the fraction of the rows in the group. All the
+    groups are computed together with vectorized operations. The result is a
+    list of 1 dict per group (keys and statistics), most songs first.
+    '''
+    if rows is None:
+        rows = np.flatnonzero(cols.valid())
+    rows = np.asarray(rows,dtype=np.int64)
+    if len(rows) == 0:
+        return []
+    key_values = np.stack([group_key(cols,key,rows).astype(np.int64)
+                           for key in keys])
+    groups,group = np.unique(key_values,axis=1,return_inverse=True)
+    group = group.reshape(-1)
+    num_groups = groups.shape[1]
+    ratio = cols.ratio(rows)
+    players = cols['players'][rows]
+    
+    songs = np.bincount(group,minlength=num_groups)
+    ratio_mean = np.bincount(group,weights=ratio,minlength=num_groups)/songs
+    # sort by group then ratio to get the medians and player extremes
+    order = np.lexsort((ratio,group))
+    starts = np.zeros(num_groups,dtype=np.int64)
+    np.cumsum(songs[:-1],out=starts[1:])
+    sorted_ratio = ratio[order]
+    ratio_median = (sorted_ratio[starts+(songs-1)//2]
+                    +sorted_ratio[starts+songs//2])/2
+    sorted_players = players[order]
+    players_min = np.minimum.reduceat(sorted_players,starts)
+    players_max = np.maximum.reduceat(sorted_players,starts)
+    # distinct (group,match) pairs counted for each group
+    pairs = np.unique(group*cols.num_matches()+cols['match'][rows])
+    matches = np.bincount(pairs//cols.num_matches(),minlength=num_groups)
+    
+    result = []
+    for g in np.argsort(-songs,kind='stable').tolist():
+        obj = {key: group_value(cols,key,int(groups[k,g]))
+               for k,key in enumerate(keys)}
+        obj['songs'] = int(songs[g])
+        obj['matches'] = int(matches[g])
+        obj['frequency'] = float(songs[g]/len(rows))
+        obj['ratioMean'] = float(ratio_mean[g])
+        obj['ratioMedian'] = float(ratio_median[g])
+        obj['playersMin'] = int(players_min[g])
+        obj['playersMax'] = int(players_max[g])
+        result.append(obj)
+    return result
+
+def read_manifest(path):
+    '''
+    Returns the manifest of the cache directory, or None if there is no usable
+    cache (missing, incomplete or a different version).
+    '''
+    try:
+        with open(os.path.join(path,'manifest.json'),'r') as f:
+            manifest = json.loads(f.read())
+    except (OSError,ValueError):
+        return None
+    if type(manifest) != dict or manifest.get('version') != CACHE_VERSION:
+        return None
+    return manifest
+
+def save(cols, path, manifest):
+    '''
+    Writes the dataset to a cache directory. The manifest is removed first and
+    written last, so an interrupted write leaves a cache that is not used. Each
+    file is replaced atomically so processes that have the old files memory
+    mapped are not affected.
+    '''
+    os.makedirs(path,exist_ok=True)
+    manifest_file = os.path.join(path,'manifest.json')
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    arrays = dict(cols.columns)
+    arrays['strings_blob'] = cols.strings.blob
+    arrays['strings_offsets'] = cols.strings.offsets
+    for name,array in arrays.items():
+        save_array(path,name,array)
+    write_manifest(cols,path,manifest)
+
+def write_manifest(cols, path, manifest):
+    '''
+    Writes only the manifest of a cache directory, for when the saved dataset
+    is already up to date.
+    '''
+    manifest_file = os.path.join(path,'manifest.json')
+    manifest = dict(manifest,version=CACHE_VERSION,
+                    rows=cols.num_rows(),matches=cols.num_matches())
+    with open(manifest_file+'.tmp','w') as f:
+        f.write(json.dumps(manifest))
+    os.replace(manifest_file+'.tmp',manifest_file)
+
+def save_array(path, name, array):
+    ''' Writes an array to the cache directory, replacing it atomically '''
+    file = os.path.join(path,name+'.npy')
+    with open(file+'.tmp','wb') as f:
+        np.save(f,np.ascontiguousarray(array))
+    os.replace(file+'.tmp',file)
+
+def load_array(path, name):
+    ''' Memory maps an array from the cache directory '''
+    file = os.path.join(path,name+'.npy')
+    try:
+        return np.load(file,mmap_mode='r')
+    except ValueError: # empty arrays cannot be memory mapped
+        return np.load(file)
+
+def load(path):
+    '''
+    Loads the dataset from a cache directory with the arrays memory mapped
+    '''
+    columns = {name: load_array(path,name)
+               for name in ROW_COLUMNS+MATCH_COLUMNS}
+    strings = StringTable(load_array(path,'strings_blob'),
+                          load_array(path,'strings_offsets'))
+    return RankedColumns(columns,strings)
@@ -1,5 +1,7 @@
 '''
-Requires the ranked_data.pickle.bz2 file to be created by running amq_loader.py.
+Requires the ranked_data.cache directory to be created by running amq_loader.py
+(and numpy). The cache is rebuilt automatically if the ranked files changed. A
+keyword index (see ranked_index.py) is stored in the cache directory as well.
 Specify query as a list of arguments to search the parameters available. Only
 one condition may be specified for each parameter, using the last one if it
 occurs multiple times.
@@ -29,6 +31,13 @@ ratio>#.#
 Both the < and > options can be specified to create a range
 The < and > symbols have to be quoted in bash
 
+Result parameters:
+orderby=[-]<ratio|correct|players|date>
+limit=##
+
+(results are in data order unless orderby is given, - is for descending order)
+(with limit, only the first ## results are given)
+
 Examples:
 
 1. Find all Love Live songs by Aqours
@@ -39,30 +48,79 @@ ranked_data_query.py animeeng="dragon ball z" type=op datenew=2020-02-29
 ranked_data_query.py animeeng="angel beats" type=ed3
 4. Find the hardest Idolm@ster songs
 ranked_data_query.py animeromaji=idolm@ster ratio"<0.05"
+ranked_data_query.py animeromaji=idolm@ster orderby=ratio limit=20
 5. Find muscle songs in games with over 300 players in 2021
 ranked_data_query.py players">300" correct"<2" correct">0" dateold=2021-01-01
 
+When used as a library, parseQuery parses the parameters once into a Query that
+can be given to queryRankedData any number of times (the command line arguments
+are not used). queryRankedData also accepts the columnar dataset from
+ranked_columns (requires numpy), which runs the same query with vectorized
+operations.
+
 The results are written to stdout as a JSON list of objects:
 {
     "date": string,
     "region": string,
     "song": object with satisfying parameters
 }
+The results are written while the query runs, so the output can be used before
+it is done. With the --jsonl option, they are written as 1 object per line.
+
+Aggregate queries group the satisfying songs instead of listing them:
+groupby=<attr>[,<attr>...]
+
+(attr is animeEng, animeRomaji, songName, artist, type, linkWebm, linkMp3,
+region, year, season or date, case sensitive)
+Each group is written as an object with the attribute values and the number of
+songs, number of matches, frequency (fraction of the songs in the group), mean
+and median ratio, and min and max players. Groups with the most songs are
+first. For example, the artists with the most songs in 2021:
+ranked_data_query.py groupby=artist dateold=2020-12-31 datenew=2022-01-01
+
+Batch mode runs many queries from a file in 1 pass over the data:
+ranked_data_query.py --batch <queries file>
+
+Each line of the file is a query, written like the command line arguments or as
+JSON (see parseBatchQueries). The results are written as 1 JSON object per line
+(JSONL), the same as above with a "query" attribute for the query tag (the line
+number if no tag is given). The results are grouped by query in file order.
+The rows in the date ranges of the queries and the columns they use are read
+once for all of them (see batchQueryRows), and the results are written as they
+are converted (see iterBatchRankedData).
 '''
 
 import amq_loader
+import heapq
+import itertools
 import json
 import re
+import shlex
 import sys
+import textwrap
+
+try: # the columnar dataset is optional (requires numpy)
+    import numpy as np
+    import ranked_columns
+    import ranked_index
+except ImportError:
+    ranked_columns = None
+
+# attributes with keyword conditions
+KEYWORD_ATTRS = ['animeEng','animeRomaji','songName','artist']
 
-def queryRankedData(data,parameters,debug=False):
+# attributes for ordering results
+ORDER_KEYS = ['ratio','correct','players','date']
+
+class Query:
+    '''
+    Query conditions parsed from a list of parameters (see parseQuery). The
+    conditions are compiled once into an ordered list of filters, leaving out
+    the ones that do not exclude anything, so the same query object can be run
+    many times on the same or different data.
+    '''
     
-    # parameter conditions
-    animeeng = []
-    animeromaji = []
-    songname = []
-    artist = []
-    typeRegex = re.compile(r'.*')
+    # default conditions (nothing excluded)
     correctLo = -1
     correctHi = 2**31 # essentially infinity
     playersLo = -1
@@ -71,89 +129,573 @@ def queryRankedData(data,parameters,debug=False):
     ratioHi = 1.1
     dateold = '2000-01-01'
     datenew = '2099-12-31'
+    # default order and limit (data order, no limit)
+    orderBy = None # attribute in ORDER_KEYS
+    descending = False
+    limit = None
+    
+    def __init__(self):
+        # keywords for animeEng, animeRomaji, songName, artist (lowercase)
+        self.keywords = {attr: [] for attr in KEYWORD_ATTRS}
+        self.typeRegex = None # None for any type
+        self._songPlan = None
+        self._columnPlans = dict()
+    
+    def ranges(self):
+        '''
+        Returns (attr,lo,hi) for the number conditions lo < attr < hi that are
+        not vacuous, attr is correct, players or ratio. The default ratio range
+        is not vacuous since it excludes songs with bad data (more correct
+        guesses than players), so the ratio condition is always used.
+        '''
+        ranges = []
+        for attr in ['correct','players']:
+            lo = getattr(self,attr+'Lo')
+            hi = getattr(self,attr+'Hi')
+            if lo != getattr(Query,attr+'Lo') or hi != getattr(Query,attr+'Hi'):
+                ranges.append((attr,lo,hi))
+        ranges.append(('ratio',self.ratioLo,self.ratioHi))
+        return ranges
+    
+    def songPlan(self):
+        '''
+        Filters for the songs in the list of ranked objects, each is a function
+        taking a song and returning if it satisfies the condition. The cheap
+        number conditions are first and the keywords (which need lowercasing
+        the song strings) are last.
+        '''
+        if self._songPlan is not None:
+            return self._songPlan
+        plan = []
+        for attr,lo,hi in self.ranges():
+            if attr == 'ratio': # computed once per song
+                plan.append(lambda song,lo=lo,hi=hi:
+                            lo < song['correct']/song['players'] < hi)
+            else:
+                plan.append(lambda song,attr=attr,lo=lo,hi=hi:
+                            lo < song[attr] < hi)
+        if self.typeRegex is not None:
+            plan.append(lambda song,regex=self.typeRegex:
+                        regex.match(song['type']) is not None)
+        for attr,words in self.keywords.items():
+            if words:
+                plan.append(lambda song,attr=attr,words=words:
+                            all(word in song[attr].lower() for word in words))
+        self._songPlan = plan
+        return plan
+    
+    def batchPlan(self):
+        '''
+        Same as songPlan but each filter takes (song,lower,ratio) where lower
+        maps the keyword attributes to the lowercase song strings and ratio is
+        correct/players, so these can be computed once per song and shared by
+        all the queries in a batch.
+        '''
+        plan = []
+        for attr,lo,hi in self.ranges():
+            if attr == 'ratio':
+                plan.append(lambda song,lower,ratio,lo=lo,hi=hi:
+                            lo < ratio < hi)
+            else:
+                plan.append(lambda song,lower,ratio,attr=attr,lo=lo,hi=hi:
+                            lo < song[attr] < hi)
+        if self.typeRegex is not None:
+            plan.append(lambda song,lower,ratio,regex=self.typeRegex:
+                        regex.match(song['type']) is not None)
+        for attr,words in self.keywords.items():
+            if words:
+                plan.append(lambda song,lower,ratio,attr=attr,words=words:
+                            all(word in lower[attr] for word in words))
+        return plan
+    
+    def columnPlan(self,indexed=False):
+        '''
+        Filters for the columnar dataset, each is a function taking the dataset,
+        the rows to check (see RankedColumns.column) and the keyword index, and
+        returning a mask for those rows. Each filter only checks the rows left
+        by the previous ones, so the most selective filters are first: the
+        keywords when a keyword index is used (otherwise they are last since
+        they have to check the strings), then the song type with a number, then
+        the number conditions.
+        '''
+        if indexed in self._columnPlans:
+            return self._columnPlans[indexed]
+        keywords = []
+        for attr,words in self.keywords.items():
+            if not words:
+                continue
+            if indexed:
+                keywords.append(lambda cols,rows,index,attr=attr,words=words:
+                                index.mask(attr,words,rows))
+            else:
+                keywords.append(lambda cols,rows,index,attr=attr,words=words:
+                    cols.string_mask(attr,
+                        lambda s: all(word in s for word in words),
+                        lower=True,rows=rows))
+        types = []
+        if self.typeRegex is not None:
+            types.append(lambda cols,rows,index,regex=self.typeRegex:
+                cols.string_mask('type',lambda s: regex.match(s) is not None,
+                                 rows=rows))
+        ranges = []
+        for attr,lo,hi in self.ranges():
+            if attr == 'ratio':
+                ranges.append(lambda cols,rows,index,lo=lo,hi=hi:
+                              rangeMask(cols.ratio(rows),lo,hi))
+            else:
+                ranges.append(lambda cols,rows,index,attr=attr,lo=lo,hi=hi:
+                              rangeMask(cols.column(attr,rows),lo,hi))
+        if indexed:
+            plan = keywords+types+ranges
+        else:
+            plan = types+ranges+keywords
+        self._columnPlans[indexed] = plan
+        return plan
+
+def rangeMask(values,lo,hi):
+    return (values > lo) & (values < hi)
+
+def parseQuery(parameters):
+    '''
+    Parses a list of parameters (like the command line arguments) into a Query
+    '''
+    query = Query()
     
-    for arg in sys.argv:
+    for arg in parameters:
         arg = arg.lower()
-        if arg.startswith('animeeng='): animeeng = arg[9:].split()
-        if arg.startswith('animeromaji='): animeromaji = arg[12:].split()
-        if arg.startswith('songname='): songname = arg[9:].split()
-        if arg.startswith('artist='): artist = arg[7:].split()
+        if arg.startswith('animeeng='):
+            query.keywords['animeEng'] = arg[9:].split()
+        if arg.startswith('animeromaji='):
+            query.keywords['animeRomaji'] = arg[12:].split()
+        if arg.startswith('songname='):
+            query.keywords['songName'] = arg[9:].split()
+        if arg.startswith('artist='):
+            query.keywords['artist'] = arg[7:].split()
         if arg.startswith('type='):
             type_ = arg[5:].lower()
             assert re.compile(r'op\d*|ed\d*|in\d*').match(type_)
             number = type_[2:]
             wordmap = {'op':'Opening','ed':'Ending','in':'Insert'}
             if number and type_[:2] != 'in':
-                typeRegex = re.compile(wordmap[type_[:2]]+' '+number)
+                query.typeRegex = re.compile(wordmap[type_[:2]]+' '+number)
             else:
-                typeRegex = re.compile(wordmap[type_[:2]]+'.*')
-        if arg.startswith('correct<'): correctHi = int(arg[8:])
-        if arg.startswith('correct>'): correctLo = int(arg[8:])
-        if arg.startswith('players<'): playersHi = int(arg[8:])
-        if arg.startswith('players>'): playersLo = int(arg[8:])
-        if arg.startswith('ratio<'): ratioHi = float(arg[6:])
-        if arg.startswith('ratio>'): ratioLo = float(arg[6:])
-        if arg.startswith('dateold='): dateold = arg[8:]
-        if arg.startswith('datenew='): datenew = arg[8:]
-    
-    assert re.compile(r'\d{4}-\d\d-\d\d').match(dateold)
-    assert re.compile(r'\d{4}-\d\d-\d\d').match(datenew)
-    
-    animeeng = [word.lower() for word in animeeng]
-    animeromaji = [word.lower() for word in animeromaji]
-    songname = [word.lower() for word in songname]
-    artist = [word.lower() for word in artist]
+                query.typeRegex = re.compile(wordmap[type_[:2]]+'.*')
+        if arg.startswith('correct<'): query.correctHi = int(arg[8:])
+        if arg.startswith('correct>'): query.correctLo = int(arg[8:])
+        if arg.startswith('players<'): query.playersHi = int(arg[8:])
+        if arg.startswith('players>'): query.playersLo = int(arg[8:])
+        if arg.startswith('ratio<'): query.ratioHi = float(arg[6:])
+        if arg.startswith('ratio>'): query.ratioLo = float(arg[6:])
+        if arg.startswith('dateold='): query.dateold = arg[8:]
+        if arg.startswith('datenew='): query.datenew = arg[8:]
+        if arg.startswith('orderby='):
+            query.descending = arg[8:].startswith('-')
+            query.orderBy = arg[8:].lstrip('-')
+            assert query.orderBy in ORDER_KEYS, 'cannot order by '+arg[8:]
+        if arg.startswith('limit='):
+            query.limit = int(arg[6:])
+            assert query.limit >= 0, 'negative limit'
+    
+    assert re.compile(r'\d{4}-\d\d-\d\d').match(query.dateold)
+    assert re.compile(r'\d{4}-\d\d-\d\d').match(query.datenew)
+    
+    return query
+
+def queryRankedData(data,parameters,debug=False,index=None):
+    '''
+    Runs the query on a list of ranked objects from amq_loader, or on a columnar
+    dataset from ranked_columns (which is evaluated with vectorized operations).
+    The parameters are a list like the command line arguments, or a Query from
+    parseQuery to avoid parsing them again. For the columnar dataset, a keyword
+    index from ranked_index can be given to use for the keyword conditions.
+    Returns a list of the results (see iterRankedData to get them 1 at a time).
+    '''
+    query = parameters if isinstance(parameters,Query) \
+        else parseQuery(parameters)
     
     if debug:
-        print('animeeng =',animeeng)
-        print('animeromaji =',animeromaji)
-        print('songname =',songname)
-        print('artist =',artist)
+        print('animeeng =',query.keywords['animeEng'])
+        print('animeromaji =',query.keywords['animeRomaji'])
+        print('songname =',query.keywords['songName'])
+        print('artist =',query.keywords['artist'])
     
-    results = []
+    return list(iterRankedData(data,query,index))
+
+def iterRankedData(data,parameters,index=None):
+    '''
+    Same as queryRankedData but returns a generator of the results, so they
+    can be used (or written) while the data is still being searched without
+    keeping all of them in memory.
+    '''
+    query = parameters if isinstance(parameters,Query) \
+        else parseQuery(parameters)
+    
+    if ranked_columns and isinstance(data,ranked_columns.RankedColumns):
+        yield from iterRankedColumns(data,query,index)
+        return
+    
+    yield from orderResults(query,scanRankedData(data,query))
+
+def scanRankedData(data,query):
+    ''' Results of the query on a list of ranked objects, in data order '''
+    plan = query.songPlan()
+    dateold,datenew = query.dateold,query.datenew
     
     for match in data:
         if match['date'] <= dateold or match['date'] >= datenew:
             continue
         for song in match['data']:
-            if any(word not in song['animeEng'].lower()
-                    for word in animeeng):
-                continue
-            if any(word not in song['animeRomaji'].lower()
-                    for word in animeromaji):
-                continue
-            if any(word not in song['songName'].lower()
-                    for word in songname):
-                continue
-            if any(word not in song['artist'].lower()
-                    for word in artist):
-                continue
-            if not typeRegex.match(song['type']):
-                continue
-            if song['correct'] <= correctLo:
-                continue
-            if song['correct'] >= correctHi:
-                continue
-            if song['players'] <= playersLo:
-                continue
-            if song['players'] >= playersHi:
-                continue
-            if song['correct']/song['players'] <= ratioLo:
-                continue
-            if song['correct']/song['players'] >= ratioHi:
-                continue
-            results.append({'date':match['date'],
-                            'region':match['region'],
-                            'song':song})
+            if all(check(song) for check in plan):
+                yield {'date':match['date'],
+                       'region':match['region'],
+                       'song':song}
+
+def resultKey(attr):
+    ''' Function giving the value of an ORDER_KEYS attribute for a result '''
+    if attr == 'date':
+        return lambda result: result['date']
+    if attr == 'ratio':
+        return lambda result: \
+            result['song']['correct']/result['song']['players']
+    return lambda result: result['song'][attr]
+
+def orderResults(query,results):
+    '''
+    Applies the order and limit of the query to an iterable of results. With a
+    limit, only the best limit results are kept in a heap while going through
+    the results (O(n log k) time and O(k) memory). Ties keep the data order.
+    '''
+    if query.orderBy is None:
+        if query.limit is None:
+            return results
+        return itertools.islice(results,query.limit)
+    key = resultKey(query.orderBy)
+    if query.limit is None:
+        return sorted(results,key=key,reverse=query.descending)
+    if query.descending:
+        return heapq.nlargest(query.limit,results,key=key)
+    return heapq.nsmallest(query.limit,results,key=key)
+
+def orderRows(cols,query,rows):
+    '''
+    Same as orderResults for the result rows of the columnar dataset. With a
+    limit, the best limit rows are found with a partial selection (O(n)) and
+    only those are sorted.
+    '''
+    if query.orderBy is None:
+        return rows if query.limit is None else rows[:query.limit]
+    if query.orderBy == 'ratio':
+        values = cols.ratio(rows)
+    elif query.orderBy == 'date':
+        values = cols['date'][cols['match'][rows]]
+    else:
+        values = cols[query.orderBy][rows]
+    if query.descending:
+        values = -values
+    k = len(rows) if query.limit is None else min(query.limit,len(rows))
+    if k == 0:
+        return rows[:0]
+    if k < len(rows):
+        # rows with values less than the kth value, then the first rows (in data
+        # order) equal to the kth value, so ties are resolved like a sort
+        kth = np.partition(values,k-1)[k-1]
+        less = np.flatnonzero(values < kth)
+        equal = np.flatnonzero(values == kth)[:k-len(less)]
+        selected = np.concatenate([less,equal])
+    else:
+        selected = np.arange(len(rows))
+    selected = selected[np.lexsort((selected,values[selected]))]
+    return rows[selected]
+
+def queryRankedColumns(cols,query,index=None):
+    '''
+    Same as queryRankedData but for the columnar dataset and a Query. Each
+    filter of the query plan is computed at once for all the rows left by the
+    previous filters, and string conditions are checked once per distinct
+    string. If a keyword index is given, keywords are found with it instead of
+    checking the strings.
+    '''
+    return list(iterRankedColumns(cols,query,index))
+
+# number of result rows converted to song dicts at a time when iterating
+RESULT_CHUNK = 1024
+
+def iterRankedColumns(cols,query,index=None):
+    '''
+    Generator version of queryRankedColumns. Only the indexes of the result rows
+    are kept, the song dicts are created in chunks as the results are used.
+    '''
+    yield from iterRowResults(cols,query,queryRankedRows(cols,query,index))
+
+def iterRowResults(cols,query,rows):
+    '''
+    Results for the rows satisfying a query (from queryRankedRows), ordered and
+    limited as the query asks, created in chunks as they are used
+    '''
+    rows = orderRows(cols,query,rows)
+    matches = dict()
+    for start in range(0,len(rows),RESULT_CHUNK):
+        chunk = rows[start:start+RESULT_CHUNK]
+        songs = cols.songs(chunk)
+        for i,song in zip(cols['match'][chunk].tolist(),songs):
+            if i not in matches: # rows are usually in match order
+                matches = {i: cols.match_info(i)}
+            yield {'date':matches[i]['date'],
+                   'region':matches[i]['region'],
+                   'song':song}
+
+def queryRankedRows(cols,query,index=None):
+    '''
+    Returns the indexes (increasing) of the rows satisfying the query
+    '''
+    # only the rows of matches in the date range are used, the date index
+    # gives them without looking at the other matches
+    rows = cols.date_rows(dateNumber(query.dateold),dateNumber(query.datenew))
+    
+    for check in [validMask]+query.columnPlan(index is not None):
+        mask = check(cols,rows,index)
+        if type(rows) == slice:
+            rows = rows.start+np.flatnonzero(mask)
+        else:
+            rows = rows[mask]
+        if len(rows) == 0:
+            break
+    return rows
+
+def dateNumber(date):
+    ''' YYYY-MM-DD date as the number YYYYMMDD (like the date column) '''
+    return int(date[:10].replace('-',''))
+
+def batchQueryRows(cols,queries,index):
+    '''
+    Returns the indexes (increasing) of the rows satisfying each query (a list
+    of Query), same as queryRankedRows for each of them but with 1 pass over
+    the columnar dataset. The rows in the date range of any query are selected
+    and checked for cleaned songs once, and the columns the queries need are
+    read for those rows once. Each query then only filters positions in these
+    arrays: the date range mask is computed once per distinct date range, the
+    strings matching a keyword (from the keyword index) or a type once per
+    keyword or type, and each filter only checks the positions left by the
+    previous ones (keywords first, like the indexed columnPlan).
+    '''
+    if len(queries) == 0:
+        return []
+    windows = {(dateNumber(query.dateold),dateNumber(query.datenew))
+               for query in queries}
+    rows = cols.date_rows(min(lo for lo,hi in windows),
+                          max(hi for lo,hi in windows))
+    if type(rows) == slice:
+        rows = np.arange(rows.start,rows.stop)
+    rows = rows[cols.valid(rows)]
+    
+    gathered = dict() # column name -> values for the rows
+    def column(name):
+        if name not in gathered:
+            if name == 'ratio':
+                gathered[name] = cols.ratio(rows)
+            elif name == 'date':
+                gathered[name] = cols['date'][cols['match'][rows]]
+            else:
+                gathered[name] = cols.column(name,rows)
+        return gathered[name]
+    
+    positions = dict() # date range -> positions of the rows in it
+    for lo,hi in windows:
+        positions[lo,hi] = np.flatnonzero(rangeMask(column('date'),lo,hi))
+    
+    strings = cols.strings.strings()
+    tables = dict() # keyword or type -> mask of the string codes matching it
+    def keywordTable(attr,word):
+        if (attr,word) not in tables:
+            table = np.zeros(len(strings)+1,dtype=np.bool_) # -1 is last
+            table[index[attr].codes(word)] = True
+            tables[attr,word] = table
+        return tables[attr,word]
+    def typeTable(regex):
+        if regex.pattern not in tables:
+            codes = np.unique(column('type'))
+            codes = codes[codes >= 0].tolist()
+            table = np.zeros(len(strings)+1,dtype=np.bool_)
+            table[codes] = [regex.match(strings[code]) is not None
+                            for code in codes]
+            tables[regex.pattern] = table
+        return tables[regex.pattern]
+    
+    results = []
+    for query in queries:
+        selected = positions[dateNumber(query.dateold),
+                             dateNumber(query.datenew)]
+        checks = [lambda selected,attr=attr,word=word:
+                  keywordTable(attr,word)[column(attr)[selected]]
+                  for attr,words in query.keywords.items() for word in words]
+        if query.typeRegex is not None:
+            checks.append(lambda selected,regex=query.typeRegex:
+                          typeTable(regex)[column('type')[selected]])
+        checks += [lambda selected,attr=attr,lo=lo,hi=hi:
+                   rangeMask(column(attr)[selected],lo,hi)
+                   for attr,lo,hi in query.ranges()]
+        for check in checks:
+            if len(selected) == 0:
+                break
+            selected = selected[check(selected)]
+        results.append(rows[selected])
     return results
 
+def aggregateRankedData(data,parameters,keys,index=None):
+    '''
+    Groups the songs satisfying the query by the keys (a list of attributes
+    from ranked_columns.GROUP_KEYS, such as artist or season) and returns the
+    statistics of each group (see ranked_columns.group_by). The data can be the
+    columnar dataset or a list of ranked objects (converted to columns first).
+    '''
+    query = parameters if isinstance(parameters,Query) \
+        else parseQuery(parameters)
+    if not isinstance(data,ranked_columns.RankedColumns):
+        data = ranked_columns.from_ranked_data(data)
+    for key in keys:
+        assert key in ranked_columns.GROUP_KEYS, 'cannot group by '+key
+    rows = queryRankedRows(data,query,index)
+    return ranked_columns.group_by(data,keys,rows)
+
+def validMask(cols,rows,index):
+    return cols.valid(rows)
+
+def writeJsonArray(results,out):
+    '''
+    Writes the results 1 at a time as a JSON list, formatted the same as
+    json.dumps(list(results),indent=4)
+    '''
+    first = True
+    for result in results:
+        out.write('[\n' if first else ',\n')
+        out.write(textwrap.indent(json.dumps(result,indent=4),' '*4))
+        first = False
+    out.write('[]\n' if first else '\n]\n')
+
+def writeJsonLines(results,out):
+    ''' Writes the results 1 at a time as JSON lines '''
+    for result in results:
+        out.write(json.dumps(result)+'\n')
+
+def parseBatchQueries(lines):
+    '''
+    Parses the queries for batchQueryRankedData from lines of text. Each line
+    is either a JSON object {"tag": any, "parameters": [str, ...]}, a JSON list
+    of parameters, or the parameters written like command line arguments
+    (quoted like in bash). Queries without a tag are tagged with their line
+    number (starting at 1). Blank lines and lines starting with # are skipped.
+    Returns a list of (tag,Query).
+    '''
+    queries = []
+    for i,line in enumerate(lines):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        tag = i+1
+        if line.startswith('{'):
+            obj = json.loads(line)
+            tag = obj.get('tag',tag)
+            parameters = obj['parameters']
+        elif line.startswith('['):
+            parameters = json.loads(line)
+        else:
+            parameters = shlex.split(line)
+        queries.append((tag,parseQuery(parameters)))
+    return queries
+
+def batchQueryRankedData(data,queries,index=None):
+    '''
+    Runs many queries (a list of Query) in 1 pass over the data, returning a
+    list with the results of each query (same as queryRankedData). For the list
+    of ranked objects, each song is lowercased and has its ratio computed once
+    for all the queries, and only the queries with the match date in range are
+    checked. For the columnar dataset, see batchQueryRows (the keyword index is
+    built if not given).
+    '''
+    if ranked_columns and isinstance(data,ranked_columns.RankedColumns):
+        if index is None:
+            index = ranked_index.build(data)
+        return [list(iterRowResults(data,query,rows)) for query,rows in
+                zip(queries,batchQueryRows(data,queries,index))]
+    
+    plans = [query.batchPlan() for query in queries]
+    attrs = [attr for attr in KEYWORD_ATTRS
+             if any(query.keywords[attr] for query in queries)]
+    results = [[] for query in queries]
+    
+    for match in data:
+        date = match['date']
+        active = [i for i,query in enumerate(queries)
+                  if query.dateold < date < query.datenew]
+        if len(active) == 0:
+            continue
+        for song in match['data']:
+            lower = {attr: song[attr].lower() for attr in attrs}
+            ratio = song['correct']/song['players']
+            for i in active:
+                if all(check(song,lower,ratio) for check in plans[i]):
+                    results[i].append({'date':date,
+                                       'region':match['region'],
+                                       'song':song})
+    return [list(orderResults(query,result))
+            for query,result in zip(queries,results)]
+
+def iterBatchRankedData(data,queries,index=None):
+    '''
+    Generator version of batchQueryRankedData, yields (i,result) for each
+    result of queries[i], grouped by query in order. For the columnar dataset
+    only the indexes of the result rows are kept, the song dicts are created as
+    the results are used.
+    '''
+    if ranked_columns and isinstance(data,ranked_columns.RankedColumns):
+        if index is None:
+            index = ranked_index.build(data)
+        for i,(query,rows) in enumerate(zip(queries,
+                batchQueryRows(data,queries,index))):
+            for result in iterRowResults(data,query,rows):
+                yield i,result
+        return
+    for i,results in enumerate(batchQueryRankedData(data,queries,index)):
+        for result in results:
+            yield i,result
+
 if __name__ == '__main__':
+    args = sys.argv[1:]
+    jsonl = '--jsonl' in args
+    args = [arg for arg in args if arg != '--jsonl']
+    groupby = [arg[8:].split(',') for arg in args
+               if arg.lower().startswith('groupby=')]
+    batch = any(arg.startswith('--batch') for arg in args)
+    if batch and not (len(args) == 2 and args[0] == '--batch'):
+        sys.stderr.write('usage: ranked_data_query.py --batch '
+                         '<queries file>\n')
+        sys.exit(1)
     sys.stderr.write('loading data...\n')
-    data = amq_loader.read_ranked_data(None,True)
-    #amq_loader.clean_ranked_data(data)
+    data = amq_loader.read_ranked_columns()
+    index = ranked_index.keyword_index(data,amq_loader.CACHE_DIR)
     sys.stderr.write('done loading\n')
-    sys.stderr.write('running query...\n')
-    query = queryRankedData(data,sys.argv[1:])
-    sys.stderr.write('done querying\n')
-    print(json.dumps(query,indent=4))
-
+    if batch:
+        sys.stderr.write('running queries...\n')
+        with open(args[1],'r') as f:
+            queries = parseBatchQueries(f)
+        results = iterBatchRankedData(data,[query for tag,query in queries],
+                                      index)
+        writeJsonLines((dict(query=queries[i][0],**result)
+                        for i,result in results),sys.stdout)
+        sys.stderr.write('done querying\n')
+    elif groupby:
+        sys.stderr.write('running query...\n')
+        groups = aggregateRankedData(data,args,groupby[-1],index)
+        sys.stderr.write('done querying\n')
+        if jsonl:
+            writeJsonLines(groups,sys.stdout)
+        else:
+            writeJsonArray(groups,sys.stdout)
+    else:
+        sys.stderr.write('running query...\n')
+        results = iterRankedData(data,args,index)
+        if jsonl:
+            writeJsonLines(results,sys.stdout)
+        else:
+            writeJsonArray(results,sys.stdout)
+        sys.stderr.write('done querying\n')
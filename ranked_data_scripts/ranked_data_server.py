@@ -0,0 +1,160 @@
+'''
+Local HTTP server answering ranked_data_query queries from a dataset that stays
+loaded in memory, so each query does not pay for loading the cache.
+
+Usage: ranked_data_server.py [port] [host]
+
+The default is port 8000 on localhost. Requires the ranked_data.cache directory
+(see ranked_data_query.py). Queries use the same parameters as
+ranked_data_query.py, either in the URL of a GET request separated with & (URL
+encoded, so < is %3C and > is %3E):
+
+GET /query?animeeng=love%20live%20sunshine&artist=aqours
+GET /query?animeromaji=idolm@ster&ratio%3C0.05
+
+or as a JSON list of parameters in the body of a POST request to /query:
+
+["animeeng=love live sunshine", "artist=aqours"]
+
+The response is the same JSON list as written by ranked_data_query.py. Errors
+are answered with a JSON object {"error": str}, with status 400 for an invalid
+request or query and 500 if the query fails. Requests are handled concurrently
+in separate threads. The cache manifest is checked in the background every few
+seconds and the dataset is reloaded (and replaced between queries) when the
+cache changes.
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+import amq_loader
+import ranked_data_query
+import ranked_index
+
+# Seconds between checks for changes to the cache
+RELOAD_INTERVAL = 5.0
+
+class RankedDataset:
+    '''
+    The loaded dataset and keyword index, replaced together when reloading so
+    a query always sees a consistent pair.
+    '''
+
+    def __init__(self, cache=amq_loader.CACHE_DIR):
+        self.cache = cache
+        self.lock = threading.Lock() # only for reloading
+        self.current = (None,None)
+        self.manifest_mtime = None
+        self.reload()
+
+    def manifest_file_mtime(self):
+        try:
+            return os.stat(os.path.join(self.cache,'manifest.json')).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self):
+        ''' Loads the dataset (updating the cache if the inputs changed) '''
+        with self.lock:
+            cols = amq_loader.read_ranked_columns(cache=self.cache)
+            index = ranked_index.keyword_index(cols,self.cache)
+            self.current = (cols,index)
+            self.manifest_mtime = self.manifest_file_mtime()
+        sys.stderr.write(f'loaded {cols.num_matches()} matches, '
+                         f'{cols.num_rows()} songs\n')
+
+    def watch(self, interval=RELOAD_INTERVAL):
+        ''' Reloads whenever the cache manifest changes (runs forever) '''
+        while True:
+            time.sleep(interval)
+            if self.manifest_file_mtime() == self.manifest_mtime:
+                continue
+            try:
+                self.reload()
+            except Exception as e: # keep serving the old data
+                sys.stderr.write(f'reload failed: {type(e).__name__}: {e}\n')
+
+    def query(self, parameters):
+        cols,index = self.current
+        query = ranked_data_query.parseQuery(parameters)
+        return ranked_data_query.queryRankedColumns(cols,query,index)
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    Handles GET and POST requests to /query (see the module documentation)
+    '''
+
+    dataset = None # RankedDataset, set by make_server
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj,separators=(',',':')).encode()
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def run_query(self, parameters):
+        if type(parameters) != list or \
+                any(type(p) != str for p in parameters):
+            self.send_json(400,{'error':'parameters must be a list of str'})
+            return
+        try:
+            results = self.dataset.query(parameters)
+        except (AssertionError,ValueError,KeyError):
+            self.send_json(400,{'error':f'invalid query: {parameters}'})
+            return
+        except Exception as e: # answer instead of dropping the connection
+            sys.stderr.write(f'query failed: {type(e).__name__}: {e}\n')
+            self.send_json(500,{'error':f'query failed: {type(e).__name__}'})
+            return
+        self.send_json(200,results)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/query':
+            self.send_json(404,{'error':'not found'})
+            return
+        parameters = [urllib.parse.unquote_plus(p)
+                      for p in url.query.split('&') if p]
+        self.run_query(parameters)
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != '/query':
+            self.send_json(404,{'error':'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length',0))
+            assert length >= 0
+        except (AssertionError,ValueError):
+            self.send_json(400,{'error':'invalid Content-Length'})
+            return
+        try:
+            parameters = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_json(400,{'error':'body must be a JSON list'})
+            return
+        self.run_query(parameters)
+
+def make_server(dataset, host='localhost', port=8000):
+    ''' Creates the server for the dataset (call serve_forever to run it) '''
+    handler = type('Handler',(QueryHandler,),{'dataset':dataset})
+    return ThreadingHTTPServer((host,port),handler)
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    host = sys.argv[2] if len(sys.argv) > 2 else 'localhost'
+    sys.stderr.write('loading data...\n')
+    dataset = RankedDataset()
+    threading.Thread(target=dataset.watch,daemon=True).start()
+    server = make_server(dataset,host,port)
+    sys.stderr.write(f'serving on http://{host}:{port}/query\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
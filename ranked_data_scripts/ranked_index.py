@@ -0,0 +1,196 @@
+'''
+Inverted keyword index for the text conditions in ranked_data_query (animeeng=,
+animeromaji=, songname=, artist=) on the columnar dataset from ranked_columns.
+
+For each indexed column, every distinct string is lowercased and split into
+trigrams (all substrings of 3 characters). The index maps each trigram to the
+sorted list of string codes (posting list) that contain it. To find the strings
+containing a keyword, the posting lists of the keyword trigrams are intersected
+and the few remaining candidates are checked with a substring test, so the
+result is exactly the same as "keyword in string.lower()". Keywords shorter
+than 3 characters are checked against the distinct strings of the column.
+
+The index can be saved in the ranked data cache directory (see amq_loader) with
+an index.json file recording which cached data it was built for, so it is
+rebuilt automatically after the cache is updated.
+
+Requires numpy.
+'''
+
+import bisect
+import json
+import numpy as np
+import os
+
+import ranked_columns
+
+# Version of the index format, indexes with a different version are rebuilt
+INDEX_VERSION = 1
+
+# String columns with a keyword index
+INDEX_COLUMNS = \
+[
+    'animeEng',
+    'animeRomaji',
+    'songName',
+    'artist'
+]
+
+# Length of the substrings in the index
+GRAM = 3
+
+class ColumnIndex:
+    '''
+    Trigram index for 1 column. grams is a sorted string table of trigrams and
+    the codes with trigram i are postings[offsets[i]:offsets[i+1]].
+    '''
+
+    def __init__(self, cols, column, grams, offsets, postings):
+        self.cols = cols
+        self.column = column
+        self.grams = grams
+        self.offsets = offsets
+        self.postings = postings
+        self._distinct = None # for short keywords
+
+    def posting(self, gram):
+        ''' Codes of the strings containing the trigram '''
+        i = bisect.bisect_left(self.grams,gram)
+        if i == len(self.grams) or self.grams[i] != gram:
+            return np.zeros(0,dtype=np.int32)
+        return self.postings[self.offsets[i]:self.offsets[i+1]]
+
+    def codes(self, word):
+        ''' Sorted codes of the strings containing word (lowercase) '''
+        strings = self.cols.strings
+        if len(word) < GRAM: # no trigrams, check every distinct string
+            if self._distinct is None:
+                codes = self.cols[self.column]
+                distinct = np.unique(codes[codes >= 0]).tolist()
+                self._distinct = [(code,strings[code].lower())
+                                  for code in distinct]
+            return np.array([code for code,s in self._distinct if word in s],
+                            dtype=np.int32)
+        postings = sorted((self.posting(word[i:i+GRAM])
+                           for i in range(len(word)-GRAM+1)),key=len)
+        result = postings[0]
+        for posting in postings[1:]:
+            if len(result) == 0:
+                break
+            result = np.intersect1d(result,posting,assume_unique=True)
+        if len(word) > GRAM: # trigrams may be in a different order
+            result = np.array([code for code in result.tolist()
+                               if word in strings[code].lower()],
+                              dtype=np.int32)
+        return result
+
+    def mask(self, words, rows=None):
+        '''
+        Mask of rows where the column contains all the words (for the given
+        rows like RankedColumns.column, all rows if None)
+        '''
+        codes = None
+        for word in words:
+            found = self.codes(word)
+            codes = found if codes is None else \
+                np.intersect1d(codes,found,assume_unique=True)
+        satisfied = np.zeros(len(self.cols.strings)+1,dtype=np.bool_)
+        if codes is None: # no words
+            satisfied[:-1] = True
+        else:
+            satisfied[codes] = True
+        return satisfied[self.cols.column(self.column,rows)]
+
+class KeywordIndex:
+    '''
+    Keyword index for all the columns in INDEX_COLUMNS, used by
+    ranked_data_query.queryRankedColumns instead of scanning the strings.
+    '''
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def mask(self, column, words, rows=None):
+        return self.columns[column].mask(words,rows)
+
+def build_column(cols, column):
+    ''' Creates the trigram index for 1 column '''
+    codes = cols[column]
+    postings = dict()
+    # codes are in increasing order so every posting list is sorted
+    for code in np.unique(codes[codes >= 0]).tolist():
+        s = cols.strings[code].lower()
+        for gram in {s[i:i+GRAM] for i in range(len(s)-GRAM+1)}:
+            if gram in postings:
+                postings[gram].append(code)
+            else:
+                postings[gram] = [code]
+    grams = sorted(postings)
+    offsets = np.zeros(len(grams)+1,dtype=np.int64)
+    np.cumsum([len(postings[gram]) for gram in grams],out=offsets[1:])
+    flat = np.array([code for gram in grams for code in postings[gram]],
+                    dtype=np.int32)
+    return ColumnIndex(cols,column,ranked_columns.StringTable.from_list(grams),
+                       offsets,flat)
+
+def build(cols):
+    ''' Creates the keyword index for the dataset '''
+    return KeywordIndex({column: build_column(cols,column)
+                         for column in INDEX_COLUMNS})
+
+def save(index, path, files):
+    '''
+    Writes the index to the cache directory. The files argument is the list of
+    input files from the cache manifest, to identify the data it belongs to.
+    '''
+    index_file = os.path.join(path,'index.json')
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    for column,col_index in index.columns.items():
+        name = 'index_'+column
+        ranked_columns.save_array(path,name+'_gram_blob',col_index.grams.blob)
+        ranked_columns.save_array(path,name+'_gram_offsets',
+                                  col_index.grams.offsets)
+        ranked_columns.save_array(path,name+'_offsets',col_index.offsets)
+        ranked_columns.save_array(path,name+'_postings',col_index.postings)
+    with open(index_file+'.tmp','w') as f:
+        f.write(json.dumps({'version':INDEX_VERSION,'files':files}))
+    os.replace(index_file+'.tmp',index_file)
+
+def load(cols, path):
+    ''' Loads the index from the cache directory with the arrays memory mapped '''
+    columns = dict()
+    for column in INDEX_COLUMNS:
+        name = 'index_'+column
+        grams = ranked_columns.StringTable(
+            ranked_columns.load_array(path,name+'_gram_blob'),
+            ranked_columns.load_array(path,name+'_gram_offsets'))
+        columns[column] = ColumnIndex(cols,column,grams,
+            ranked_columns.load_array(path,name+'_offsets'),
+            ranked_columns.load_array(path,name+'_postings'))
+    return KeywordIndex(columns)
+
+def keyword_index(cols, cache=None):
+    '''
+    Returns the keyword index for the dataset. If cols was loaded from the given
+    cache directory, the index saved there is used if it is up to date,
+    otherwise it is built and saved for next time.
+    '''
+    manifest = ranked_columns.read_manifest(cache) if cache else None
+    if manifest is None or manifest['rows'] != cols.num_rows():
+        return build(cols)
+    try:
+        with open(os.path.join(cache,'index.json'),'r') as f:
+            index_manifest = json.loads(f.read())
+    except (OSError,ValueError):
+        index_manifest = None
+    if type(index_manifest) == dict and \
+            index_manifest.get('version') == INDEX_VERSION and \
+            index_manifest.get('files') == manifest['files']:
+        return load(cols,cache)
+    index = build(cols)
+    save(index,cache,manifest['files'])
+    return index